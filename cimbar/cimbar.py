@@ -5,10 +5,14 @@
 Usage:
   ./cimbar.py <IMAGES>... --output=<filename> [--config=<sq8x8,sq5x5,sq5x6>] [--dark | --light]
                          [--colorbits=<0-3>] [--deskew=<0-2>] [--ecc=<0-200>]
-                         [--fountain] [--preprocess=<0,1>] [--color-correct]
+                         [--fountain] [--preprocess=<0,1>] [--color-correct] [--color-lut=<0-7>] [--jobs=<N>]
+                         [--track] [--direct-sample] [--lens-profile=<name>] [--lens-profiles=<filename>]
+                         [--cache-dir=<dir>]
+  ./cimbar.py --calibrate=<name> <IMAGES>... [--config=<sq8x8,sq5x5,sq5x6>] [--dark | --light]
+                                             [--lens-profiles=<filename>]
   ./cimbar.py --encode (<src_data> | --src_data=<filename>) (<output> | --output=<filename>)
                        [--config=<sq8x8,sq5x5,sq5x6>] [--dark | --light]
-                       [--colorbits=<0-3>] [--ecc=<0-150>] [--fountain]
+                       [--colorbits=<0-3>] [--ecc=<0-150>] [--fountain] [--jobs=<N>] [--cache-dir=<dir>]
   ./cimbar.py (-h | --help)
 
 Examples:
@@ -27,11 +31,23 @@ Options:
   --dark                           Use dark palette. [default]
   --light                          Use light palette.
   --color-correct                  Attempt color correction.
+  --color-lut=<0-7>                Decode colors with a (2^N)^3 lookup table. 0 does the full color math per cell.
+                                   Not used with --color-correct. [default: 0]
+  -j --jobs=<N>                    Decode (or encode) up to N images at once, in separate processes. [default: 1]
+  --cache-dir=<dir>                Save precomputed tables here, and load them from here on the next run.
+  --track                          Images are frames of a video: look for the anchors where they were in the last one.
+  --direct-sample                  Deskew straight into the padded frame the cell decoders read from.
+  --calibrate=<name>               Estimate the lens distortion from the images, and save it as a lens profile.
+  --lens-profile=<name>            Undo the lens distortion saved by --calibrate, instead of estimating it per image.
+  --lens-profiles=<filename>       Lens profiles file. Default is ~/.config/cimbar/lens-profiles.json
   --deskew=<0-2>                   Deskew level. 0 is no deskew. Should usually be 0 or default. [default: 1]
   --preprocess=<0,1>               Sharpen image before decoding. Default is to guess. [default: -1]
 """
-from os import path
-from tempfile import TemporaryDirectory
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache, partial
+from itertools import islice
+from os import makedirs, path
 
 import cv2
 import numpy
@@ -39,15 +55,23 @@ from docopt import docopt
 from PIL import Image
 
 from cimbar import conf
-from cimbar.deskew.deskewer import deskewer
-from cimbar.encode.cell_positions import cell_positions, AdjacentCellFinder, FloodDecodeOrder
-from cimbar.encode.cimb_translator import CimbEncoder, CimbDecoder, avg_color
+from cimbar.deskew.deskewer import deskew_image
+from cimbar.deskew.lens_profile import calibrate, load_profile, save_profile
+from cimbar.deskew.tracker import AnchorTracker
+from cimbar.encode.cell_hash import pad_frame
+from cimbar.encode.cell_positions import cell_drift, WavefrontDecodeOrder
+from cimbar.encode.cimb_translator import CimbEncoder, CimbDecoder, TILE_ASSETS, avg_color, summed_area_table, tile_assets
+from cimbar.encode.cimb_translator import COLOR_LUTS, load_tile_assets, save_tile_assets
+from cimbar.encode.layout_plan import layout_plan
+from cimbar.encode.rs_codec import NumpyCodec
 from cimbar.encode.rss import reed_solomon_stream
-from cimbar.util.bit_file import bit_file
-from cimbar.util.interleave import interleave, interleave_reverse, interleaved_writer
+from cimbar.fountain.header import fountain_header
+from cimbar.util.bit_file import bit_file, pack_cells
 
 
 BITS_PER_COLOR=conf.BITS_PER_COLOR
+FRAME_MARGIN = cell_drift.limit + 1  # max distance a drifted cell can stray outside the frame
+ERASURE_DISTANCE = 15  # symbol hash distance. Not many cells are this far off, and a lot of those are wrong
 
 
 def get_deskew_params(level):
@@ -74,51 +98,84 @@ def _fountain_chunk_size(ecc=conf.ECC, bits_per_op=bits_per_op(), fountain_block
     return capacity(bits_per_op) * (conf.ECC_BLOCK_SIZE-ecc) // conf.ECC_BLOCK_SIZE // fountain_blocks
 
 
-def detect_and_deskew(src_image, temp_image, dark, auto_dewarp=False):
-    return deskewer(src_image, temp_image, dark, auto_dewarp=auto_dewarp)
+def best_drift(distances):
+    '''
+    for each row of an (N, len(cell_drift.pairs)) distances array, pick the drift the same way we always have:
+    the first offset that's good enough (distance < 8), or else the last offset with the smallest distance.
+    '''
+    good = distances < 8
+    last_min = distances.shape[1] - 1 - distances[:, ::-1].argmin(axis=1)
+    return numpy.where(good.any(axis=1), good.argmax(axis=1), last_min)
 
 
-def _decode_cell(ct, img, color_img, x, y, drift):
-    best_distance = 1000
-    for dx, dy in drift.pairs:
-        testX = x + drift.x + dx
-        testY = y + drift.y + dy
-        img_cell = img.crop((testX, testY, testX + conf.CELL_SIZE, testY + conf.CELL_SIZE))
-        bits, min_distance = ct.decode_symbol(img_cell)
-        best_distance = min(min_distance, best_distance)
-        if min_distance == best_distance:
-            best_bits = bits
-            best_dx = dx
-            best_dy = dy
-        if min_distance < 8:
-            break
+def _decode_wave(ct, frame, positions, drifts):
+    # frame is the (padded) grayscale symbol image. Try every drift offset for every cell in the wave at once.
+    pairs = numpy.array(cell_drift.pairs)
+    xs = positions[:, 0, None] + drifts[:, 0, None] + pairs[None, :, 0] + FRAME_MARGIN
+    ys = positions[:, 1, None] + drifts[:, 1, None] + pairs[None, :, 1] + FRAME_MARGIN
+    bits, distances = ct.decode_symbols(frame, xs.ravel(), ys.ravel(), conf.CELL_SIZE)
 
-    testX = x + drift.x + best_dx
-    testY = y + drift.y + best_dy
-    best_cell = color_img.crop((testX+1, testY+1, testX + conf.CELL_SIZE-2, testY + conf.CELL_SIZE-2))
-    return best_bits + ct.decode_color(best_cell), best_dx, best_dy, best_distance
+    distances = distances.reshape(xs.shape)
+    best = best_drift(distances)
+    cells = numpy.arange(len(best))
+    best_dx, best_dy = pairs[best].T
+    return bits.reshape(xs.shape)[cells, best], best_dx, best_dy, distances[cells, best]
+
+
+def _decode_colors(ct, color_table, xs, ys):
+    # the color is the average of the inside of the cell, e.g. a 5x5 square for an 8x8 cell
+    xs = numpy.asarray(xs) + 1 + FRAME_MARGIN
+    ys = numpy.asarray(ys) + 1 + FRAME_MARGIN
+    return ct.decode_colors(color_table, xs, ys, conf.CELL_SIZE-3)
 
 
 def _preprocess_for_decode(img):
-    ''' This might need to be conditional based on source image size.'''
-    img = cv2.cvtColor(numpy.array(img), cv2.COLOR_RGB2BGR)
+    ''' This might need to be conditional based on source image size. img is an RGB array -> grayscale array'''
     kernel = numpy.array([[-1.0,-1.0,-1.0], [-1.0,8.5,-1.0], [-1.0,-1.0,-1.0]])
-    img = cv2.filter2D(img, -1, kernel)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    img = Image.fromarray(img)
+    img = cv2.filter2D(numpy.asarray(img), -1, kernel)
+    return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+
+def _to_grayscale(img):
+    # the same rounding as PIL's convert('L'), which is what the symbol hashes were tuned against
+    if img.ndim == 2:
+        return img
+    r, g, b = (img[..., i].astype(numpy.uint32) for i in range(3))
+    return ((r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16).astype(numpy.uint8)
+
+
+def load_image(src_image):
+    '''
+    src_image is a filename, an encoded image (e.g. png or jpg bytes), or an image array in cv2's BGR order.
+    returns a BGR array.
+    '''
+    if isinstance(src_image, numpy.ndarray):
+        img = src_image
+    elif isinstance(src_image, (bytes, bytearray, memoryview)):
+        img = cv2.imdecode(numpy.frombuffer(src_image, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+    else:
+        img = cv2.imread(src_image)
+    if img is None:
+        raise ValueError('failed to read image')
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
     return img
 
 
 def _get_decoder_stream(outfile, ecc, fountain):
     # set up the outstream: image -> reedsolomon -> fountain -> zstd_decompress -> raw bytes
+    # returns (outstream, the fountain_decoder_stream or None)
     f = open(outfile, 'wb')
+    fstream = None
     if fountain:
         import zstandard as zstd
         from cimbar.fountain.fountain_decoder_stream import fountain_decoder_stream
         decompressor = zstd.ZstdDecompressor().stream_writer(f)
-        f = fountain_decoder_stream(decompressor, _fountain_chunk_size(ecc))
+        f = fstream = fountain_decoder_stream(decompressor, _fountain_chunk_size(ecc))
     on_rss_failure = b'' if fountain else None
-    return reed_solomon_stream(f, ecc, conf.ECC_BLOCK_SIZE, mode='write', on_failure=on_rss_failure) if ecc else f
+    if ecc:
+        f = reed_solomon_stream(f, ecc, conf.ECC_BLOCK_SIZE, mode='write', on_failure=on_rss_failure)
+    return f, fstream
 
 
 def compute_tint(img, dark):
@@ -136,66 +193,263 @@ def compute_tint(img, dark):
         pos = [(67, 0), (0, 67), (conf.TOTAL_SIZE-79, 0), (0, conf.TOTAL_SIZE-79)]
 
     for x, y in pos:
-        iblock = img.crop((x, y, x + 4, y + 4))
-        r, g, b = avg_color(iblock)
+        iblock = img[y:y + 4, x:x + 4]
         update(cc, *avg_color(iblock))
 
     print(f'tint is {cc}')
     return cc['r'], cc['g'], cc['b']
 
 
-def _decode_iter(ct, img, color_img):
-    cell_pos, num_edge_cells = cell_positions(conf.CELL_SPACING_X, conf.CELL_SPACING_Y, conf.CELL_DIM_X,
-                                              conf.CELL_DIM_Y, conf.CELLS_OFFSET, conf.MARKER_SIZE_X, conf.MARKER_SIZE_Y)
-    finder = AdjacentCellFinder(cell_pos, num_edge_cells, conf.CELL_DIM_X, conf.MARKER_SIZE_X)
-    decode_order = FloodDecodeOrder(cell_pos, finder)
-    for i, (x, y), drift in decode_order:
-        best_bits, best_dx, best_dy, best_distance = _decode_cell(ct, img, color_img, x, y, drift)
+def _pad_for_drift(img, margin):
+    # the cell decoders want FRAME_MARGIN px around the frame. The image might already have (some of) it
+    pad = FRAME_MARGIN - margin
+    return pad_frame(img, pad) if pad else img
+
+
+def _decode_cells(ct, img, color_img, margin=0):
+    decode_order = WavefrontDecodeOrder(layout_plan())
+    frame = _pad_for_drift(_to_grayscale(img), margin)
+
+    indices = []
+    symbols = []
+    distances = []
+    xs = []
+    ys = []
+    for wave, positions, drifts in decode_order:
+        best_bits, best_dx, best_dy, best_distance = _decode_wave(ct, frame, positions, drifts)
+        indices.append(wave)
+        symbols.append(best_bits)
+        distances.append(best_distance)
+        xs.append(positions[:, 0] + drifts[:, 0] + best_dx)
+        ys.append(positions[:, 1] + drifts[:, 1] + best_dy)
         decode_order.update(best_dx, best_dy, best_distance)
-        yield i, best_bits
-
 
-def decode_iter(src_image, dark, should_preprocess, should_color_correct, deskew, auto_dewarp):
-    tempdir = None
+    # colors don't affect drift, so we can do them all at once
+    color_table = summed_area_table(_pad_for_drift(color_img, margin))
+    colors = _decode_colors(ct, color_table, numpy.concatenate(xs), numpy.concatenate(ys))
+    indices = numpy.concatenate(indices)
+    cells = numpy.zeros(len(decode_order.layout.positions), dtype=int)
+    cells[indices] = numpy.concatenate(symbols) + colors
+    cell_distances = numpy.zeros(len(cells), dtype=int)
+    cell_distances[indices] = numpy.concatenate(distances)
+    return cells, cell_distances
+
+
+def _decode_some_cells(ct, img, color_img, indices, margin=0):
+    # just the cells at indices. There's no wavefront to carry the drift along, so each cell gets a drift search
+    # around where it should be
+    positions = layout_plan().positions[indices]
+    frame = _pad_for_drift(_to_grayscale(img), margin)
+    bits, dx, dy, _ = _decode_wave(ct, frame, positions, numpy.zeros_like(positions))
+
+    color_table = summed_area_table(_pad_for_drift(color_img, margin))
+    return bits + _decode_colors(ct, color_table, positions[:, 0] + dx, positions[:, 1] + dy)
+
+
+def _prepare_image(src_image, dark, should_preprocess, should_color_correct, deskew, auto_dewarp, color_lut_bits=None,
+                   direct_sample=False, distortion_factor=None, tracker=None):
+    '''
+    everything before the cells are decoded: load, deskew, preprocess.
+    returns (ct, img, color_img, margin) -- the arguments _decode_cells() wants.
+    '''
+    img = load_image(src_image)
+    margin = 0
     if deskew:
-        tempdir = TemporaryDirectory()
-        temp_img = path.join(tempdir.name, path.basename(src_image))
-        dims = detect_and_deskew(src_image, temp_img, dark, auto_dewarp)
+        height, width = img.shape[:2]
+        margin = FRAME_MARGIN if direct_sample else 0
+        img = deskew_image(img, dark, auto_dewarp=auto_dewarp, tracker=tracker, margin=margin,
+                           distortion_factor=distortion_factor)
+        if img is None:
+            raise ValueError('failed to deskew image')
         if should_preprocess < 0:
-            should_preprocess = dims[0] < conf.TOTAL_SIZE or dims[1] < conf.TOTAL_SIZE
-        color_img = Image.open(temp_img)
-    else:
-        color_img = Image.open(src_image)
+            should_preprocess = height < conf.TOTAL_SIZE or width < conf.TOTAL_SIZE
+    color_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
-    ct = CimbDecoder(dark, symbol_bits=conf.BITS_PER_SYMBOL, color_bits=conf.BITS_PER_COLOR)
+    ct = CimbDecoder(dark, symbol_bits=conf.BITS_PER_SYMBOL, color_bits=conf.BITS_PER_COLOR,
+                     color_lut_bits=color_lut_bits)
     img = _preprocess_for_decode(color_img) if should_preprocess else color_img
 
     if should_color_correct:
         from colormath.chromatic_adaptation import _get_adaptation_matrix
-        ct.ccm = _get_adaptation_matrix(numpy.array([*compute_tint(color_img, dark)]),
+        frame = color_img[margin:len(color_img) - margin, margin:len(color_img) - margin]
+        ct.ccm = _get_adaptation_matrix(numpy.array([*compute_tint(frame, dark)]),
                                         numpy.array([255, 255, 255]), 2, 'von_kries')
+    return ct, img, color_img, margin
+
+
+def decode_cells(src_image, dark, should_preprocess, should_color_correct, deskew, auto_dewarp, color_lut_bits=None,
+                 direct_sample=False, distortion_factor=None, tracker=None, with_distances=False):
+    '''
+    src_image can be anything load_image() understands -- a filename, encoded image bytes, or a BGR array.
+    tracker is an optional AnchorTracker, shared between the frames of a video.
+    direct_sample: when deskewing, sample the border the cell decoders need (for drift) from src_image too,
+    instead of deskewing to a TOTAL_SIZE frame and padding a copy of it with black.
+    distortion_factor: a calibrated lens distortion to undo while deskewing. See lens_profile.
+    returns an array of the decoded bits for each cell, in cell index order.
+    with_distances, also returns each cell's hash distance to its symbol -- how (un)sure we are about it.
+    '''
+    prepared = _prepare_image(src_image, dark, should_preprocess, should_color_correct, deskew, auto_dewarp,
+                              color_lut_bits, direct_sample, distortion_factor, tracker)
+    cells, distances = _decode_cells(*prepared)
+    return (cells, distances) if with_distances else cells
+
+
+def decode_iter(src_image, dark, should_preprocess, should_color_correct, deskew, auto_dewarp, color_lut_bits=None):
+    cells = decode_cells(src_image, dark, should_preprocess, should_color_correct, deskew, auto_dewarp, color_lut_bits)
+    for i, bits in enumerate(cells.tolist()):
+        yield i, bits
+
+
+def _byte_distances(distances, bits_per_op, num_bytes):
+    # each byte gets the worst distance of the cells it has bits from. A cell can straddle two bytes
+    first = numpy.arange(len(distances)) * bits_per_op // 8
+    last = ((numpy.arange(len(distances)) + 1) * bits_per_op - 1) // 8
+    byte_distances = numpy.zeros(num_bytes, dtype=distances.dtype)
+    numpy.maximum.at(byte_distances, first, distances)
+    numpy.maximum.at(byte_distances, last, distances)
+    return byte_distances
+
+
+@lru_cache(maxsize=None)
+def _rs_codec(ecc):
+    return NumpyCodec(ecc, conf.ECC_BLOCK_SIZE)
+
+
+def _frame_id(frame_bytes, ecc):
+    '''
+    a fountain frame is a run of chunks, so the header of the first one says which frame it is.
+    returns its (encode_id, chunk_id), or None if the ecc block it's in doesn't decode.
+    '''
+    if ecc:
+        frame_bytes = next(_rs_codec(ecc).decode(frame_bytes[:conf.ECC_BLOCK_SIZE]))
+        if frame_bytes is None:
+            return None
+    hdr = fountain_header(frame_bytes[:fountain_header.length])
+    return hdr.encode_id, hdr.chunk_id
+
+
+def _frame_id_cells(ecc):
+    # the (block ordered) cells _frame_id() needs: the whole first ecc block, or without ecc, just the header
+    num_bytes = conf.ECC_BLOCK_SIZE if ecc else fountain_header.length
+    return layout_plan().block_order[:-(-num_bytes * 8 // bits_per_op())]
+
+
+def _decode_frame(decode_args, src_image, tracker=None, seen=None, ecc=0):
+    '''
+    cells -> ecc blocks -> bytes.
+    returns (frame_bytes, byte_distances) -- the second is how unsure we are about each byte. See _byte_distances().
+    seen is an optional set of fountain _frame_id()s we already have. If this is one of them, we only decode the
+    cells it takes to find that out, and return None.
+    '''
+    prepared = _prepare_image(src_image, *decode_args, tracker=tracker)
+    if seen:
+        id_cells = _decode_some_cells(*prepared[:3], _frame_id_cells(ecc), prepared[3])
+        if _frame_id(pack_cells(id_cells, bits_per_op()), ecc) in seen:
+            return None
+
+    cells, distances = _decode_cells(*prepared)
+    order = layout_plan().block_order
+    frame_bytes = pack_cells(cells[order], bits_per_op())
+    return frame_bytes, _byte_distances(distances[order], bits_per_op(), len(frame_bytes))
+
+
+def _init_worker(settings, bits_per_color, assets, color_luts):
+    global BITS_PER_COLOR
+    BITS_PER_COLOR = bits_per_color
+    for k, v in settings.items():
+        setattr(conf, k, v)
+    TILE_ASSETS.update(assets)
+    COLOR_LUTS.update(color_luts)
+
+
+def _process_pool(jobs, dark, color_bits):
+    # workers might not have forked from us, so give them our config (and skip rebuilding the tiles, and any color
+    # lookup tables we've already got)
+    settings = {k: v for k, v in vars(conf).items() if k.isupper()}
+    tiles_key = (conf.BITS_PER_SYMBOL, color_bits, bool(dark))
+    assets = {tiles_key: tile_assets(*tiles_key)}
+    initargs = (settings, BITS_PER_COLOR, assets, dict(COLOR_LUTS))
+    return ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=initargs)
+
+
+def _decode_frames(src_images, decode_args, jobs=1, in_order=True, track=False, seen=None, ecc=0):
+    '''
+    yields _decode_frame() for each image.
+    with jobs > 1, the images are decoded in a process pool -- and if in_order is False, yielded as soon as they're done.
+    Out of order, only a few images are in flight at a time: each one is sent with what's in seen when it goes,
+    and when we stop early, the rest are never started.
+    track only applies to jobs == 1, since otherwise consecutive frames go to different processes.
+    '''
+    dark = decode_args[0]
+    if jobs <= 1:
+        tracker = AnchorTracker(dark) if track else None
+        for imgf in src_images:
+            yield _decode_frame(decode_args, imgf, tracker, seen, ecc)
+        return
 
-    yield from _decode_iter(ct, img, color_img)
-
-    if tempdir:  # cleanup
-        with tempdir:
-            pass
+    with _process_pool(jobs, dark, conf.BITS_PER_COLOR) as executor:
+        if in_order:
+            yield from executor.map(partial(_decode_frame, decode_args), src_images)
+            return
+
+        images = iter(src_images)
+        pending = set()
+        try:
+            while True:
+                for imgf in islice(images, 2 * jobs - len(pending)):
+                    snapshot = frozenset(seen) if seen else None
+                    pending.add(executor.submit(_decode_frame, decode_args, imgf, None, snapshot, ecc))
+                if not pending:
+                    return
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _frame_losses(outstream, fstream):
+    # running counts of what we couldn't use: ecc blocks that didn't decode, and fountain chunks for segments too far
+    # ahead. A frame is only done with if it didn't add to them
+    return getattr(outstream, 'failed_blocks', 0), fstream.dropped if fstream else 0
 
 
 def decode(src_images, outfile, dark=False, ecc=conf.ECC, fountain=False, force_preprocess=False, color_correct=False,
-           deskew=True, auto_dewarp=False):
-    cells, _ = cell_positions(conf.CELL_SPACING_X, conf.CELL_SPACING_Y, conf.CELL_DIM_X, conf.CELL_DIM_Y,
-                              conf.CELLS_OFFSET, conf.MARKER_SIZE_X, conf.MARKER_SIZE_Y)
-    interleave_lookup, block_size = interleave_reverse(cells, conf.INTERLEAVE_BLOCKS, conf.INTERLEAVE_PARTITIONS)
-    dstream = _get_decoder_stream(outfile, ecc, fountain)
+           deskew=True, auto_dewarp=False, color_lut_bits=None, jobs=1, track=False, direct_sample=False,
+           distortion_factor=None, erasure_distance=ERASURE_DISTANCE):
+    '''
+    erasure_distance: bytes with a cell at least this far from its symbol are erasures, for ecc blocks that don't
+    decode without them. None to not use erasures.
+    '''
+    decode_args = (dark, force_preprocess, color_correct, deskew, auto_dewarp, color_lut_bits, direct_sample,
+                   distortion_factor)
+    dstream, fstream = _get_decoder_stream(outfile, ecc, fountain)
+    # a fountain frame we've decoded cleanly once has nothing more to give us. Cameras tend to catch each one a few times
+    seen = set() if fountain else None
     with dstream as outstream:
-        for imgf in src_images:
-            with interleaved_writer(f=outstream, bits_per_op=bits_per_op(), mode='write', keep_open=True) as iw:
-                decoding = {i: bits for i, bits in decode_iter(imgf, dark, force_preprocess, color_correct, deskew,
-                                                               auto_dewarp)}
-                for i, bits in sorted(decoding.items()):
-                    block = interleave_lookup[i] // block_size
-                    iw.write(bits, block)
+        # fountain chunks can go in any order. Otherwise, the frames have to be in sequence.
+        for frame in _decode_frames(src_images, decode_args, jobs, in_order=not fountain, track=track, seen=seen,
+                                    ecc=ecc):
+            if frame is None:  # seen it
+                continue
+
+            frame_bytes, byte_distances = frame
+            losses = _frame_losses(outstream, fstream)
+            if ecc and erasure_distance is not None:
+                outstream.write(frame_bytes, byte_distances >= erasure_distance)
+            else:
+                outstream.write(frame_bytes)
+
+            if not fountain:
+                continue
+            if fstream.done:
+                break
+            frame_id = _frame_id(frame_bytes, ecc)
+            if frame_id is not None and _frame_losses(outstream, fstream) == losses:
+                seen.add(frame_id)
+            # encode_id is only 7 bits: once a segment is written out, its ids come around again for a new one
+            seen.difference_update([i for i in seen if fstream.written(i[0])])
 
 
 def _get_image_template(width, dark):
@@ -225,6 +479,13 @@ def _get_image_template(width, dark):
     return img
 
 
+@lru_cache(maxsize=None)
+def _get_template_array(width, dark):
+    template = numpy.asarray(_get_image_template(width, dark))
+    template.setflags(write=False)
+    return template
+
+
 def _get_encoder_stream(src, ecc, fountain, compression_level=6):
     # various checks to set up the instream.
     # the hierarchy is raw bytes -> zstd -> fountain -> reedsolomon -> image
@@ -237,7 +498,7 @@ def _get_encoder_stream(src, ecc, fountain, compression_level=6):
     estream = reed_solomon_stream(f, ecc, conf.ECC_BLOCK_SIZE) if ecc else f
 
     read_size = _fountain_chunk_size(ecc) if fountain else 16384
-    read_count = (f.len // read_size) * 2 if fountain else 1
+    read_count = None if fountain else 1  # the fountain stream knows when it's sent enough
     params = {
         'read_size': read_size,
         'read_count': read_count,
@@ -245,38 +506,94 @@ def _get_encoder_stream(src, ecc, fountain, compression_level=6):
     return estream, params
 
 
-def encode_iter(src_data, ecc, fountain):
+def encode_frames(src_data, ecc, fountain):
+    '''
+    yields (frame_num, cells) for each frame, where cells is an array of cell values in interleaved order
+    -- e.g. the order of layout_plan().positions[layout_plan().interleave]
+    '''
     estream, params = _get_encoder_stream(src_data, ecc, fountain)
     with estream as instream, bit_file(instream, bits_per_op=bits_per_op(), **params) as f:
+        plan = layout_plan()
+        assert len(plan.positions) == num_cells()
+
         frame_num = 0
-        while f.read_count > 0:
-            cells, _ = cell_positions(conf.CELL_SPACING_X, conf.CELL_SPACING_Y, conf.CELL_DIM_X, conf.CELL_DIM_Y,
-                                      conf.CELLS_OFFSET, conf.MARKER_SIZE_X, conf.MARKER_SIZE_Y)
-            assert len(cells) == num_cells()
-            for x, y in interleave(cells, conf.INTERLEAVE_BLOCKS, conf.INTERLEAVE_PARTITIONS):
-                bits = f.read()
-                yield bits, x, y, frame_num
+        while f.read_count != 0:
+            yield frame_num, f.read_cells(len(plan.positions))
             frame_num += 1
 
 
-def encode(src_data, dst_image, dark=False, ecc=conf.ECC, fountain=False):
-    def save_frame(img, frame):
-        if img:
-            name = dst_image if not frame else f'{dst_image}.{frame}.png'
-            img.save(name)
+def encode_iter(src_data, ecc, fountain):
+    plan = layout_plan()
+    positions = plan.positions[plan.interleave].tolist()
+    for frame_num, cells in encode_frames(src_data, ecc, fountain):
+        for bits, (x, y) in zip(cells.tolist(), positions):
+            yield bits, x, y, frame_num
+
+
+@lru_cache(maxsize=None)
+def _get_encoder(dark, symbol_bits, color_bits):
+    return CimbEncoder(dark, symbol_bits=symbol_bits, color_bits=color_bits)
+
+
+def _render_frame(ct, cells, dark):
+    plan = layout_plan()
+    positions = plan.positions[plan.interleave]
+    frame = _get_template_array(conf.TOTAL_SIZE, dark).copy()
+    ct.encode_cells(frame, positions[:, 0], positions[:, 1], cells)
+    return Image.fromarray(frame)
+
+
+def _save_frame(dark, name, cells):
+    ct = _get_encoder(dark, conf.BITS_PER_SYMBOL, BITS_PER_COLOR)
+    _render_frame(ct, cells, dark).save(name)
+
+
+def _frame_name(dst_image, frame_num):
+    return dst_image if not frame_num else f'{dst_image}.{frame_num}.png'
+
 
-    img = None
-    frame = None
-    ct = CimbEncoder(dark, symbol_bits=conf.BITS_PER_SYMBOL, color_bits=BITS_PER_COLOR)
-    for bits, x, y, frame_num in encode_iter(src_data, ecc, fountain):
-        if frame != frame_num:  # save
-            save_frame(img, frame)
-            img = _get_image_template(conf.TOTAL_SIZE, dark)
-            frame = frame_num
+def encode(src_data, dst_image, dark=False, ecc=conf.ECC, fountain=False, jobs=1):
+    '''
+    with jobs > 1, frames are rendered and saved in a process pool. Reading the encoded stream stays in this process,
+    so frame numbering (and the output filenames) don't change.
+    '''
+    frames = encode_frames(src_data, ecc, fountain)
+    if jobs <= 1:
+        for frame_num, cells in frames:
+            _save_frame(dark, _frame_name(dst_image, frame_num), cells)
+        return
+
+    with _process_pool(jobs, dark, BITS_PER_COLOR) as executor:
+        pending = deque()
+        for frame_num, cells in frames:
+            pending.append(executor.submit(_save_frame, dark, _frame_name(dst_image, frame_num), cells))
+            if len(pending) >= 2 * jobs:  # don't get too far ahead of the workers
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+
+
+def _load_caches(cache_dir, dark, color_lut_bits=0):
+    # tables that only depend on the config. Load them if an earlier run saved them, and save them if it didn't
+    makedirs(cache_dir, exist_ok=True)
+    layout_plan(cache_dir=cache_dir)
 
-        encoded = ct.encode(bits)
-        img.paste(encoded, (x, y))
-    save_frame(img, frame)
+    if color_lut_bits:
+        # same decoder settings as _prepare_image(), so its decoders find the table in COLOR_LUTS
+        CimbDecoder(dark, symbol_bits=conf.BITS_PER_SYMBOL, color_bits=conf.BITS_PER_COLOR,
+                    color_lut_bits=color_lut_bits, color_lut_dir=cache_dir).color_lut()
+
+    tiles_key = (conf.BITS_PER_SYMBOL, BITS_PER_COLOR, bool(dark))
+    tiles_file = path.join(cache_dir, 'tiles-{}-{}-{}.npz'.format(*map(int, tiles_key)))
+    try:
+        if tiles_key in load_tile_assets(tiles_file):
+            return
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        save_tile_assets(tiles_file, [tiles_key])
+    except OSError as e:
+        print(f'failed to save tile assets {tiles_file}: {e}')
 
 
 def main():
@@ -295,19 +612,35 @@ def main():
     except:
         ecc = conf.ECC
     fountain = bool(args.get('--fountain'))
+    jobs = int(args.get('--jobs'))
+    if args['--cache-dir']:
+        _load_caches(args['--cache-dir'], dark, int(args.get('--color-lut') or 0))
+
+    if args['--calibrate']:
+        distortion_factor = calibrate((load_image(imgf) for imgf in args['<IMAGES>']), dark)
+        if distortion_factor is None:
+            print('failed to estimate the lens distortion :(')
+            return
+        save_profile(args['--calibrate'], distortion_factor, args['--lens-profiles'])
+        return
 
     if args['--encode']:
         src_data = args['<src_data>'] or args['--src_data']
         dst_image = args['<output>'] or args['--output']
-        encode(src_data, dst_image, dark, ecc, fountain)
+        encode(src_data, dst_image, dark, ecc, fountain, jobs)
         return
 
     deskew = get_deskew_params(args.get('--deskew'))
     should_preprocess = int(args.get('--preprocess'))
     color_correct = args['--color-correct']
+    color_lut_bits = int(args.get('--color-lut'))
     src_images = args['<IMAGES>']
     dst_data = args['<output>'] or args['--output']
-    decode(src_images, dst_data, dark, ecc, fountain, should_preprocess, color_correct, **deskew)
+    lens_profile = args['--lens-profile']
+    distortion_factor = load_profile(lens_profile, args['--lens-profiles']) if lens_profile else None
+    decode(src_images, dst_data, dark, ecc, fountain, should_preprocess, color_correct, color_lut_bits=color_lut_bits,
+           jobs=jobs, track=args['--track'], direct_sample=args['--direct-sample'],
+           distortion_factor=distortion_factor, **deskew)
 
 
 if __name__ == '__main__':
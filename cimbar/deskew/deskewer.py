@@ -1,32 +1,108 @@
+from collections import deque
+from functools import lru_cache
 from math import sqrt
 
 import cv2
 import numpy
 
 from cimbar import conf
-from cimbar.deskew.scanner import CimbarScanner
+from cimbar.deskew.scanner import get_scanner
 
 
 ANCHOR_SIZE = 30
 ED_DIST = 3
+CORNER_TOLERANCE = 1  # px. Alignments whose corners are all within this (in x and y) of a cached one share its maps
+REMAP_CACHE_SIZE = 16
 
+_REMAP_MAPS = deque(maxlen=REMAP_CACHE_SIZE)  # (params, input_pts, maps). Most recently used last
 
-def correct_perspective(img, target_size, input_pts, output_pts):
+
+def _cached_maps(params, input_pts, tolerance, compute):
+    # compare against the cached corners, rather than rounding to a grid: a corner that jitters across a
+    # rounding boundary would miss every time
+    pts = numpy.asarray(input_pts, dtype=numpy.float64)
+    for i, (cached_params, cached_pts, maps) in enumerate(_REMAP_MAPS):
+        if cached_params == params and numpy.abs(cached_pts - pts).max() <= tolerance:
+            del _REMAP_MAPS[i]
+            _REMAP_MAPS.append((cached_params, cached_pts, maps))
+            return maps
+
+    maps = compute()
+    _REMAP_MAPS.append((params, pts, maps))
+    return maps
+
+
+def _homography_grid(target_size, input_pts, output_pts):
     transformer = cv2.getPerspectiveTransform(numpy.float32(input_pts), numpy.float32(output_pts))
-    return cv2.warpPerspective(img, transformer, target_size)
+    _, m = cv2.invert(transformer, flags=cv2.DECOMP_LU)
 
+    # for each output pixel, where it comes from in the input image -- what warpPerspective does internally
+    width, height = target_size
+    x = numpy.arange(width, dtype=numpy.float64)[None, :]
+    y = numpy.arange(height, dtype=numpy.float64)[:, None]
+    w = m[2, 0] * x + m[2, 1] * y + m[2, 2]
+    map_x = ((m[0, 0] * x + m[0, 1] * y + m[0, 2]) / w).astype(numpy.float32)
+    map_y = ((m[1, 0] * x + m[1, 1] * y + m[1, 2]) / w).astype(numpy.float32)
+    return map_x, map_y
 
-def _naive_radial_undistort(img, distortion_factor):
+
+def _fixed_point_maps(map_x, map_y):
+    map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+    map1.setflags(write=False)
+    map2.setflags(write=False)
+    return map1, map2
+
+
+def _perspective_maps(target_size, input_pts, output_pts):
+    return _fixed_point_maps(*_homography_grid(target_size, input_pts, output_pts))
+
+
+def _undistorted_perspective_maps(image_size, distortion_factor, target_size, input_pts, output_pts):
+    map_x, map_y = _homography_grid(target_size, input_pts, output_pts)
+    undistort_x, undistort_y = _undistort_maps(image_size, distortion_factor)
+    # look up where the (undistorted) pixels the perspective transform wants are in the distorted image,
+    # so the image only gets resampled once
+    return _fixed_point_maps(
+        cv2.remap(undistort_x, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=-1),
+        cv2.remap(undistort_y, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=-1),
+    )
+
+
+def perspective_maps(target_size, input_pts, output_pts, tolerance=CORNER_TOLERANCE, image_size=None,
+                     distortion_factor=None):
     '''
-    This is a "works on my box" kind of function. Ideally this is a last resort (or entirely unnecessary),
-    because we'll have the lens distortion parameters cached.
+    fixed point (CV_16SC2) cv2.remap() maps for the perspective transform from input_pts to output_pts.
+    If every corner is within `tolerance` px of the ones we computed recent maps for, we reuse those -- so a stable
+    alignment (e.g. a camera on a tripod) doesn't recompute them every frame.
 
-    distortion factor calculated by _get_distortion_factor()
+    with a distortion_factor (and the (width, height) image_size it applies to), input_pts are undistorted
+    coordinates, and the maps undo the lens distortion too.
+    '''
+    target_size = tuple(target_size)
+    output_pts = tuple(tuple(p) for p in output_pts)
+    if distortion_factor is None:
+        params = (target_size, output_pts)
+        return _cached_maps(params, input_pts, tolerance,
+                            lambda: _perspective_maps(target_size, input_pts, output_pts))
+
+    image_size = tuple(image_size)
+    params = (target_size, output_pts, image_size, distortion_factor)
+    return _cached_maps(params, input_pts, tolerance, lambda: _undistorted_perspective_maps(
+        image_size, distortion_factor, target_size, input_pts, output_pts))
+
+
+def correct_perspective(img, target_size, input_pts, output_pts, out=None, distortion_factor=None):
+    '''
+    out is an optional preallocated buffer (target_size, with img's channels and dtype) to write the result into.
+    distortion_factor is an optional (calibrated) lens distortion to undo in the same pass -- see undistort_points().
     '''
     height, width = img.shape[:2]
-    print('***')
-    print(f'{height},{width}, ... {distortion_factor}')
+    map1, map2 = perspective_maps(target_size, input_pts, output_pts, image_size=(width, height),
+                                  distortion_factor=distortion_factor)
+    return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, dst=out)
 
+
+def _camera_params(width, height, distortion_factor):
     distCoeff = numpy.zeros((4,1),numpy.float64)
     distCoeff[0,0] = distortion_factor  # k1. ex: -0.0043366581750921215
     distCoeff[1,0] = 0 # k2. 0
@@ -38,7 +114,37 @@ def _naive_radial_undistort(img, distortion_factor):
     cam[1,2] = height / 2  #  center of distortion Y
     cam[0,0] = width / 4  # "good enough" focal length
     cam[1,1] = height / 4
+    return cam, distCoeff
+
 
+@lru_cache(maxsize=4)
+def _undistort_maps(image_size, distortion_factor):
+    # the same mapping cv2.undistort() uses, as float maps we can compose with others
+    cam, distCoeff = _camera_params(*image_size, distortion_factor)
+    return cv2.initUndistortRectifyMap(cam, distCoeff, None, cam, image_size, cv2.CV_32FC1)
+
+
+def undistort_points(pts, image_size, distortion_factor):
+    '''
+    where pts (in an image of (width, height) image_size) end up after undoing the lens distortion
+    '''
+    cam, distCoeff = _camera_params(*image_size, distortion_factor)
+    pts = cv2.undistortPoints(numpy.float32(pts).reshape(-1, 1, 2), cam, distCoeff, P=cam)
+    return [tuple(p) for p in pts.reshape(-1, 2).tolist()]
+
+
+def _naive_radial_undistort(img, distortion_factor):
+    '''
+    This is a "works on my box" kind of function. Ideally this is a last resort (or entirely unnecessary),
+    because we'll have the lens distortion parameters cached.
+
+    distortion factor calculated by _get_distortion_factor()
+    '''
+    height, width = img.shape[:2]
+    print('***')
+    print(f'{height},{width}, ... {distortion_factor}')
+
+    cam, distCoeff = _camera_params(width, height, distortion_factor)
     return cv2.undistort(img, cam, distCoeff)
 
 
@@ -72,6 +178,8 @@ def _get_distortion_factor(align, target_ratio):
         if edj:
             ratio = distance(edj, line_mid) / distance(line_start, line_end)
             all_ratios.append(ratio)
+    if not all_ratios:
+        return None
     avg = sum(all_ratios) / len(all_ratios)
     return target_ratio - avg
 
@@ -79,39 +187,84 @@ def _get_distortion_factor(align, target_ratio):
 def fix_lens_distortion(img, dest_size, anchor_size, align):
     target_ratio = _edge_to_anchor_ratio(dest_size, anchor_size)
     df = _get_distortion_factor(align, target_ratio)
+    if df is None:
+        return img
     return _naive_radial_undistort(img, df)
 
 
-def scan(img, dark, use_edges, size, anchor_size):
-    cs = CimbarScanner(img, dark)
-    align = cs.scan()
+def estimate_distortion_factor(img, dark, anchor_size=ANCHOR_SIZE):
+    '''
+    the distortion factor fix_lens_distortion() would use for img, or None if we can't find the edges
+    '''
+    size = conf.TOTAL_SIZE
+    align = scan(img, dark, True, size, anchor_size)
+    if not align:
+        return None
+    return _get_distortion_factor(align, _edge_to_anchor_ratio(size, anchor_size))
+
+
+def scan(img, dark, use_edges, size, anchor_size, tracker=None):
+    '''
+    tracker is an optional AnchorTracker, for when img is one of a sequence of frames
+    '''
+    cs = None
+    if tracker:
+        align = tracker.scan(img)
+    else:
+        cs = get_scanner(img, dark)
+        align = cs.scan()
     if len(align.corners) < 4:
         return None
     if use_edges:
+        cs = cs or get_scanner(img, dark)
         align = cs.scan_edges(align, anchor_size)
     return align
 
 
-def deskewer(src_image, dst_image, dark, use_edges=True, auto_dewarp=True, anchor_size=ANCHOR_SIZE):
+def deskew_image(img, dark, use_edges=True, auto_dewarp=True, anchor_size=ANCHOR_SIZE, tracker=None, out=None,
+                 margin=0, distortion_factor=None):
+    '''
+    img is a numpy array, e.g. from cv2.imread(). Returns the deskewed (conf.TOTAL_SIZE square) array, or None.
+    tracker is an optional AnchorTracker, to reuse what we learned from the previous frame.
+    out is an optional preallocated buffer for the result -- see correct_perspective().
+    margin adds that many px of border around the frame, sampled from img like the rest of it.
+    distortion_factor is a calibrated one (see lens_profile) to use instead of estimating it for every image.
+    '''
     size = conf.TOTAL_SIZE
 
-    img = cv2.imread(src_image)
-    align = scan(img, dark, use_edges, size, anchor_size)
+    # the edges are only needed to dewarp
+    dewarp = use_edges and auto_dewarp and distortion_factor is None
+    align = scan(img, dark, dewarp, size, anchor_size, tracker)
     if not align:
         print('didnt detect enough points! :(')
         return None
 
-    if use_edges and auto_dewarp:
+    if dewarp:
         img = fix_lens_distortion(img, size, anchor_size, align)
         # need to recalculate alignment after dewarp :(
         align = scan(img, dark, use_edges, size, anchor_size)
+        if not align:
+            return None
 
     input_pts = [align.top_left, align.top_right, align.bottom_right, align.bottom_left]
+    if distortion_factor is not None:
+        height, width = img.shape[:2]
+        input_pts = undistort_points(input_pts, (width, height), distortion_factor)
     output_pts = [
         (anchor_size, anchor_size), (size-anchor_size, anchor_size),
         (size-anchor_size, size-anchor_size), (anchor_size, size-anchor_size)
     ]
+    output_pts = [(x + margin, y + margin) for x, y in output_pts]
+
+    size += 2 * margin
+    return correct_perspective(img, (size, size), input_pts, output_pts, out, distortion_factor)
+
+
+def deskewer(src_image, dst_image, dark, use_edges=True, auto_dewarp=True, anchor_size=ANCHOR_SIZE):
+    img = cv2.imread(src_image)
+    out = deskew_image(img, dark, use_edges, auto_dewarp, anchor_size)
+    if out is None:
+        return None
 
-    out = correct_perspective(img, (size, size), input_pts, output_pts)
     cv2.imwrite(dst_image, out)
     return img.shape[:2]
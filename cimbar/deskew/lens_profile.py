@@ -0,0 +1,57 @@
+import json
+from os import environ, makedirs, path
+
+import numpy
+
+from cimbar.deskew.deskewer import ANCHOR_SIZE, estimate_distortion_factor
+
+
+PROFILES_FILE = 'lens-profiles.json'
+
+
+def default_profiles_file():
+    '''
+    $XDG_CONFIG_HOME/cimbar/lens-profiles.json -- usually ~/.config/cimbar/lens-profiles.json
+    '''
+    config_dir = environ.get('XDG_CONFIG_HOME') or path.join(path.expanduser('~'), '.config')
+    return path.join(config_dir, 'cimbar', PROFILES_FILE)
+
+
+def calibrate(images, dark, anchor_size=ANCHOR_SIZE):
+    '''
+    estimate a device's lens distortion factor from a batch of images (numpy arrays) taken with it.
+    Images where we can't find the edges are skipped. Returns None if that's all of them.
+    '''
+    factors = [estimate_distortion_factor(img, dark, anchor_size) for img in images]
+    factors = [df for df in factors if df is not None]
+    if not factors:
+        return None
+    return float(numpy.median(factors))
+
+
+def load_profiles(filename=None):
+    filename = filename or default_profiles_file()
+    if not path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_profile(name, distortion_factor, filename=None):
+    filename = filename or default_profiles_file()
+    profiles = load_profiles(filename)
+    makedirs(path.dirname(path.abspath(filename)), exist_ok=True)
+    profiles[name] = {'distortion_factor': distortion_factor}
+    with open(filename, 'w') as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+
+
+def load_profile(name, filename=None):
+    '''
+    returns the distortion factor saved for name
+    '''
+    filename = filename or default_profiles_file()
+    profiles = load_profiles(filename)
+    if name not in profiles:
+        raise KeyError(f'no lens profile named {name} in {filename}')
+    return profiles[name]['distortion_factor']
@@ -4,6 +4,9 @@ import numpy
 from cimbar.util.geometry import calculate_midpoints
 
 
+PYRAMID_SIZE = 1536  # PyramidScanner downscales images to about this size
+
+
 def next_power_of_two_plus_one(x):
     return 2**((x - 1).bit_length()) + 1
 
@@ -125,6 +128,50 @@ class ScanState:
         return None
 
 
+def scan_line(line, ratio='1:1:4'):
+    '''
+    does what feeding each pixel of line (a 1D bool array) to ScanState.process() -- and then one last process(False) --
+    would, using run lengths instead of a pixel at a time.
+    returns (ends, widths) arrays. ends are where process() returned the widths, so len(line) is the final flush.
+    '''
+    empty = numpy.zeros(0, dtype=int)
+    line = numpy.asarray(line, dtype=bool)
+    if not line.any():
+        return empty, empty
+
+    # runs of active/inactive pixels, starting with the first active one
+    starts = numpy.flatnonzero(line[1:] != line[:-1]) + 1
+    starts = numpy.concatenate(([0], starts, [len(line)]))
+    if not line[0]:
+        starts = starts[1:]
+    runs = numpy.diff(starts)
+    if len(runs) < 5:
+        return empty, empty
+
+    # a pattern is checked whenever an active run ends: at the start of each inactive run, or at the end of the line.
+    # the first check needs 5 runs.
+    ends = starts[5:len(runs)+1:2]
+    windows = runs[numpy.arange(0, 2 * len(ends), 2)[:, None] + numpy.arange(5)]
+
+    center = windows[:, 2, None]
+    ones = windows[:, [0, 1, 3, 4]]
+
+    # ScanState keys the limits by run length, so when two runs are the same length, the last one's limits win
+    limits = numpy.array(ScanState.RATIO_LIMITS[ratio])[[0, 1, 1, 0]]
+    which = numpy.arange(4)
+    if (limits != limits[0]).any():
+        which = numpy.broadcast_to(which, ones.shape).copy()
+        for p in range(4):
+            for q in range(p + 1, 4):
+                which[:, p] = numpy.where(ones[:, q] == ones[:, p], q, which[:, p])
+    lo, hi = limits[which, 0], limits[which, 1]
+
+    ratio_min = center / (ones + 1)
+    ratio_max = center / numpy.maximum(1, ones - 1)
+    good = ~((ratio_max < lo) | (ratio_min > hi)).any(axis=1)
+    return ends[good], windows[good].sum(axis=1)
+
+
 class EdgeScanState:
     def __init__(self):
         self.state = 0
@@ -153,15 +200,23 @@ class EdgeScanState:
         return None
 
 
-def _the_works(img):
-    x = int(min(img.shape[0], img.shape[1]) * 0.002)
+def _filter_units(image_size):
+    x = int(min(image_size) * 0.002)
     blur_unit = next_power_of_two_plus_one(x)
     blur_unit = max(3, blur_unit)  # needs to be at least 3
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    img = cv2.GaussianBlur(img,(blur_unit,blur_unit),0)
 
-    x = int(min(img.shape[0], img.shape[1]) * 0.05)
+    x = int(min(image_size) * 0.05)
     thresh_unit = next_power_of_two_plus_one(x)
+    return blur_unit, thresh_unit
+
+
+def _the_works(img, image_size=None):
+    '''
+    image_size is the (height, width) of the image that img was cut from, if it's only a piece of it.
+    '''
+    blur_unit, thresh_unit = _filter_units(image_size or img.shape[:2])
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    img = cv2.GaussianBlur(img,(blur_unit,blur_unit),0)
     img = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, thresh_unit, 0)
     return img
 
@@ -206,15 +261,16 @@ class CimbarAlignment:
 
 
 class CimbarScanner:
-    def __init__(self, img, dark=False, skip=17):
+    def __init__(self, img, dark=False, skip=17, image_size=None):
         '''
-        image dimensions need to not be divisible by skip
+        image dimensions need to not be divisible by skip.
+        image_size is the (height, width) of the full image, if img is only a region of it.
         '''
-        self.img = _the_works(img)
+        self.img = _the_works(img, image_size)
         self.height, self.width = self.img.shape
         self.dark = dark
         self.skip = skip or self.height // 200
-        self.cutoff = self.height // 30
+        self.cutoff = (image_size or self.img.shape)[0] // 30
         self.scan_ratio = '1:1:4'
 
     def _test_pixel(self, x, y):
@@ -223,6 +279,12 @@ class CimbarScanner:
         else:
             return self.img[y, x] < 127
 
+    def _active(self, pixels):
+        if self.dark:
+            return pixels > 127
+        else:
+            return pixels < 127
+
     def horizontal_scan(self, y, r=None):
         # for each column, look for the 1:1:4:1:1 pattern
         if r:
@@ -230,18 +292,9 @@ class CimbarScanner:
         else:
             r = (0, self.width)
 
-        state = ScanState(self.scan_ratio)
-        for x in range(*r):
-            active = self._test_pixel(x, y)
-            res = state.process(active)
-            if res:
-                #print('found possible anchor at {}-{},{}'.format(x - res, x, y))
-                yield Anchor(x=x-res, xmax=x-1, y=y)
-
-        # if the pattern is at the edge of the range
-        res = state.process(False)
-        if res:
-            x = r[1]
+        # if the pattern is at the edge of the range, x == r[1]
+        ends, widths = scan_line(self._active(self.img[y, r[0]:max(r[0], r[1])]), self.scan_ratio)
+        for x, res in zip((ends + r[0]).tolist(), widths.tolist()):
             yield Anchor(x=x-res, xmax=x-1, y=y)
 
     def vertical_scan(self, x, xmax=None, r=None):
@@ -253,18 +306,9 @@ class CimbarScanner:
         else:
             r = (0, self.height)
 
-        state = ScanState(self.scan_ratio)
-        for y in range(*r):
-            active = self._test_pixel(xavg, y)
-            res = state.process(active)
-            if res:
-                #print('found possible anchor at {},{}-{}'.format(xavg, y-res, y))
-                yield Anchor(x=x, xmax=xmax, y=y-res, ymax=y-1)
-
-         # if the pattern is at the edge of the range
-        res = state.process(False)
-        if res:
-            y = r[1]
+        # if the pattern is at the edge of the range, y == r[1]
+        ends, widths = scan_line(self._active(self.img[r[0]:max(r), xavg]), self.scan_ratio)
+        for y, res in zip((ends + r[0]).tolist(), widths.tolist()):
             yield Anchor(x=x, xmax=xmax, y=y-res, ymax=y-1)
 
     def diagonal_scan(self, start_x, end_x, start_y, end_y):
@@ -283,22 +327,12 @@ class CimbarScanner:
 
         #print(f'diagonally scanning from {start_x},{start_y} to {end_x},{end_y}')
 
-        state = ScanState(self.scan_ratio)
-        x = start_x
-        y = start_y
-        while x < end_x and y < end_y:
-            active = self._test_pixel(x, y)
-            res = state.process(active)
-            if res:
-                ax, axmax = (x-res, x)
-                ay, aymax = (y-res, y)
-                yield Anchor(x=ax, xmax=axmax, y=ay, ymax=aymax)
-            x += 1
-            y += 1
-
-         # if the pattern is at the edge of the image
-        res = state.process(False)
-        if res:
+        length = max(0, min(end_x - start_x, end_y - start_y))
+        steps = numpy.arange(length)
+        ends, widths = scan_line(self._active(self.img[start_y + steps, start_x + steps]), self.scan_ratio)
+        for i, res in zip(ends.tolist(), widths.tolist()):
+            x = start_x + i
+            y = start_y + i
             yield Anchor(x=x-res, xmax=x, y=y-res, ymax=y)
 
     def t1_scan_horizontal(self, skip=None, start_y=None, end_y=None, r=None):
@@ -596,3 +630,125 @@ class CimbarScanner:
         ]
         edges = [self.find_edge(start, end, mid, anchor_size) for start, end, mid in bounds]
         return CimbarAlignment(align.corners, edges, mp)
+
+
+def region_scanner(img, dark, center, radius, skip=17):
+    '''
+    a CimbarScanner for the part of img within radius of center. Returns (scanner, (x0, y0)) -- where (x0, y0) is the
+    scanner's top left corner in img, so it needs to be added to anything the scanner finds.
+    '''
+    height, width = img.shape[:2]
+    x, y = center
+
+    # pad the region, so the threshold at its edges matches what we'd see in the full image
+    blur_unit, thresh_unit = _filter_units((height, width))
+    pad = blur_unit // 2 + thresh_unit // 2
+    x0, y0 = max(0, x - radius - pad), max(0, y - radius - pad)
+    x1, y1 = min(width, x + radius + pad + 1), min(height, y + radius + pad + 1)
+    if x0 >= x1 or y0 >= y1:
+        return None, (x0, y0)
+    return CimbarScanner(img[y0:y1, x0:x1], dark, skip=skip, image_size=(height, width)), (x0, y0)
+
+
+def closest_anchor(candidates, center, radius, offset=(0, 0)):
+    '''
+    the candidate closest to center (and within radius of it), moved by offset. Or None.
+    '''
+    x, y = center
+    ox, oy = offset
+    best = None
+    best_distance = radius ** 2
+    for c in candidates:
+        distance = (c.xavg + ox - x) ** 2 + (c.yavg + oy - y) ** 2
+        if distance <= best_distance:
+            best = Anchor(x=c.x + ox, xmax=c.xmax + ox, y=c.y + oy, ymax=c.ymax + oy)
+            best_distance = distance
+    return best
+
+
+def scan_region(img, dark, center, radius, ratio='1:1:4', merge=True, skip=None):
+    '''
+    look for an anchor within radius of center, in img's full resolution.
+    Returns the closest one (in img's coordinates), or None.
+    '''
+    x, y = center
+    roi, (x0, y0) = region_scanner(img, dark, center, radius, skip=skip or max(1, radius // 16))
+    if not roi:
+        return None
+
+    roi.scan_ratio = ratio
+    candidates = roi.t1_scan_horizontal(start_y=max(0, y - y0 - radius), end_y=y - y0 + radius,
+                                        r=(x - x0 - radius, x - x0 + radius))
+    candidates = roi.t2_scan_vertical(candidates)
+    candidates = roi.t3_scan_diagonal(candidates)
+    candidates = roi.t4_confirm_scan(candidates, merge=merge)
+    return closest_anchor(candidates, center, radius, (x0, y0))
+
+
+class PyramidScanner:
+    '''
+    for big images: finds the anchors on a downscaled copy of img, then pins each one down in a small region of the
+    full resolution image. Same interface as CimbarScanner.
+    '''
+    def __init__(self, img, dark=False, max_size=PYRAMID_SIZE):
+        height, width = img.shape[:2]
+        self.img = img
+        self.dark = dark
+        self.scale = -(-max(height, width) // max_size)
+
+        s = self.scale
+        small = cv2.resize(img[:height // s * s, :width // s * s], (width // s, height // s),
+                           interpolation=cv2.INTER_AREA)
+        self.coarse = CimbarScanner(small, dark)
+
+    def _to_full(self, p):
+        return tuple(int(v * self.scale + self.scale // 2) for v in p)
+
+    def _refine(self, center, anchor_range, ratio, merge):
+        '''
+        scan the full resolution neighborhood of a coarse anchor. Returns the full resolution center -- or, if the
+        anchor can't be found there, the coarse one, scaled up.
+        '''
+        x, y = self._to_full(center)
+        radius = (anchor_range + 2) * self.scale
+        anchor = scan_region(self.img, self.dark, (x, y), radius, ratio, merge, skip=max(self.scale, radius // 16))
+        if not anchor:
+            # the coarse position is still good to within self.scale px. Worse, but usually decodable
+            print(f'failed to refine anchor at {(x, y)}. Using the coarse ({self.scale}x) position')
+            return x, y
+        return anchor.xavg, anchor.yavg
+
+    def scan(self):
+        cs = self.coarse
+        cs.scan_ratio = '1:1:4'
+        candidates = cs.t1_scan_horizontal()
+        candidates = cs.t2_scan_vertical(candidates)
+        candidates = cs.t3_scan_diagonal(candidates)
+        candidates = cs.t4_confirm_scan(candidates)
+        filtered_candidates, max_range = cs.filter_candidates(candidates)
+        print(f'coarse ({self.scale}x): {filtered_candidates}')
+        if len(filtered_candidates) < 3:
+            return CimbarAlignment([])
+
+        candidates = cs.sort_top_to_bottom(filtered_candidates)
+        corners = [self._refine((c.xavg, c.yavg), c.max_range, '1:1:4', True) for c in candidates]
+
+        fourth = cs.add_fourth_corner(candidates, max_range)[3:]
+        if fourth:
+            corners.append(self._refine(fourth[0], max_range, '1:2:2', False))
+        return CimbarAlignment(corners)
+
+    def scan_edges(self, align, anchor_size):
+        # the edges only feed the lens distortion estimate, so the coarse image is good enough
+        s = self.scale
+        coarse = CimbarAlignment([(x // s, y // s) for x, y in align.corners])
+        coarse = self.coarse.scan_edges(coarse, anchor_size)
+        edges = [self._to_full(e) if e else None for e in coarse.edges]
+        return CimbarAlignment(align.corners, edges, calculate_midpoints(align))
+
+
+def get_scanner(img, dark):
+    # big images get scanned coarse-to-fine
+    if max(img.shape[:2]) > PYRAMID_SIZE:
+        return PyramidScanner(img, dark)
+    return CimbarScanner(img, dark)
@@ -0,0 +1,84 @@
+from math import sqrt
+
+from cimbar.deskew.scanner import CimbarAlignment, closest_anchor, get_scanner, region_scanner
+
+
+ANCHOR_RATIO = 60 / 964  # anchor width : distance between anchor centers, on a 1024x1024 code
+
+
+class AnchorTracker:
+    '''
+    for a sequence of frames (e.g. video): looks for each anchor near where it was in the last frame,
+    and only scans the whole frame when that doesn't work.
+    '''
+    def __init__(self, dark, window=1.0):
+        '''
+        window is how far (in anchor widths) an anchor can move between frames and still be tracked.
+        '''
+        self.dark = dark
+        self.window = window
+        self.corners = None
+        self.anchor_width = None
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self):
+        self.corners = None
+        self.anchor_width = None
+
+    def _track_anchor(self, img, center, ratio, merge):
+        width = max(4, int(self.anchor_width))
+        radius = int(width * self.window)
+        roi, (x0, y0) = region_scanner(img, self.dark, center, radius + width)
+        if not roi:
+            return None
+
+        # instead of a t1 scan of every skip'th row, just scan the rows through where the anchor was
+        roi.scan_ratio = ratio
+        x, y = center[0] - x0, center[1] - y0
+        candidates = []
+        for dy in (0, -width // 4, width // 4):
+            candidates += roi.horizontal_scan(y + dy, r=(x - radius, x + radius))
+        candidates = roi.t2_scan_vertical(candidates)
+        candidates = roi.t3_scan_diagonal(candidates)
+        candidates = roi.t4_confirm_scan(candidates, merge=merge)
+        return closest_anchor(candidates, center, radius, (x0, y0))
+
+    def _track(self, img):
+        corners = []
+        widths = []
+        for i, center in enumerate(self.corners):
+            # the bottom right anchor is the odd one out
+            ratio, merge = ('1:2:2', False) if i == 3 else ('1:1:4', True)
+            anchor = self._track_anchor(img, center, ratio, merge)
+            if not anchor:
+                return None
+            corners.append((anchor.xavg, anchor.yavg))
+            widths.append(anchor.max_range)
+
+        self.anchor_width = max(widths[:3])
+        return CimbarAlignment(corners)
+
+    def _update(self, corners):
+        if len(corners) < 4:
+            self.reset()
+            return
+        self.corners = [tuple(int(v) for v in c) for c in corners]
+        (x0, y0), (x1, y1) = self.corners[:2]
+        self.anchor_width = sqrt((x1 - x0) ** 2 + (y1 - y0) ** 2) * ANCHOR_RATIO
+
+    def scan(self, img):
+        '''
+        returns a CimbarAlignment, like CimbarScanner.scan()
+        '''
+        if self.corners:
+            align = self._track(img)
+            if align:
+                self.hits += 1
+                self.corners = align.corners
+                return align
+
+        self.misses += 1
+        align = get_scanner(img, self.dark).scan()
+        self._update(align.corners)
+        return align
@@ -0,0 +1,116 @@
+from functools import lru_cache
+from math import pi, sin
+
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+HASH_SIZE = 8
+PRECISION_BITS = 22  # PIL's fixed point precision for 8 bit resampling
+
+
+def _sinc(x):
+    if x == 0.0:
+        return 1.0
+    x = x * pi
+    return sin(x) / x
+
+
+def _lanczos(x):
+    if -3.0 <= x < 3.0:
+        return _sinc(x) * _sinc(x / 3)
+    return 0.0
+
+
+@lru_cache(maxsize=None)
+def resample_coefficients(in_size, out_size):
+    '''
+    fixed point lanczos weights, computed the same way PIL does for Image.resize(..., LANCZOS).
+    imagehash.average_hash() upscales our 5x5 cells to 8x8 with this filter, so we need to match it exactly.
+    '''
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = 3.0 * filterscale
+
+    coeffs = numpy.zeros((out_size, in_size), dtype=numpy.int64)
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+        weights = [_lanczos((x + xmin - center + 0.5) / filterscale) for x in range(xmax - xmin)]
+        total = sum(weights)
+        for x, w in enumerate(weights):
+            if total != 0.0:
+                w /= total
+            coeffs[xx, x + xmin] = int(-0.5 + w * (1 << PRECISION_BITS)) if w < 0 else int(0.5 + w * (1 << PRECISION_BITS))
+    return coeffs
+
+
+def _clip8(ss):
+    return numpy.where(ss >= (256 << PRECISION_BITS), 255, numpy.where(ss <= 0, 0, ss >> PRECISION_BITS))
+
+
+def resample(cells, out_size=HASH_SIZE):
+    # horizontal pass, then vertical pass -- same order and rounding as PIL
+    half = 1 << (PRECISION_BITS - 1)
+    coeffs = resample_coefficients(cells.shape[-1], out_size)
+    horizontal = _clip8(cells.astype(numpy.int64) @ coeffs.T + half)
+    coeffs = resample_coefficients(cells.shape[-2], out_size)
+    return _clip8(numpy.matmul(coeffs, horizontal) + half).astype(numpy.uint8)
+
+
+def pad_frame(frame, margin):
+    '''
+    PIL's crop() fills out-of-bounds areas with black. Padding the frame lets us do the same thing with array views.
+    '''
+    pad = [(margin, margin), (margin, margin)] + [(0, 0)] * (frame.ndim - 2)
+    return numpy.pad(frame, pad)
+
+
+def cell_windows(frame, xs, ys, size):
+    '''
+    returns an (N, size, size) (or (N, size, size, channels)) array of the cells at (xs, ys)
+    '''
+    windows = sliding_window_view(frame, (size, size), axis=(0, 1))
+    cells = windows[numpy.asarray(ys), numpy.asarray(xs)]
+    if cells.ndim == 4:  # color: (N, channels, size, size) -> (N, size, size, channels)
+        cells = numpy.moveaxis(cells, 1, -1)
+    return cells
+
+
+def average_hashes(cells, hash_size=HASH_SIZE):
+    '''
+    equivalent to imagehash.average_hash() for each grayscale cell in an (N, size, size) array.
+    returns an (N, hash_size*hash_size) bool array.
+    '''
+    if cells.shape[-1] != hash_size or cells.shape[-2] != hash_size:
+        cells = resample(cells, hash_size)
+    pixels = cells.reshape(len(cells), -1).astype(numpy.int32)
+    # pixels > mean, without the float division
+    return pixels * pixels.shape[1] > pixels.sum(axis=1, keepdims=True)
+
+
+def pack_hashes(hash_bits):
+    '''
+    (N, 64) bool array -> (N,) uint64 array. Bit order matches str(imagehash.ImageHash).
+    '''
+    packed = numpy.packbits(numpy.asarray(hash_bits, dtype=bool), axis=1)
+    return numpy.ascontiguousarray(packed).view('>u8').ravel().astype(numpy.uint64)
+
+
+_POPCOUNT_TABLE = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+
+def _table_popcount(values):
+    values = numpy.ascontiguousarray(values, dtype=numpy.uint64)
+    return _POPCOUNT_TABLE[values.view(numpy.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=numpy.uint8)
+
+
+popcount = getattr(numpy, 'bitwise_count', _table_popcount)  # numpy.bitwise_count is numpy >= 2.0
+
+
+def hamming_distances(hashes, references):
+    '''
+    (N,) and (K,) packed hashes -> (N, K) distances
+    '''
+    return popcount(numpy.bitwise_xor(hashes[:, None], references[None, :]))
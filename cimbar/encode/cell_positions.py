@@ -1,5 +1,7 @@
-from copy import copy
-from heapq import heappush, heappop
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy
 
 
 class cell_drift:
@@ -72,81 +74,35 @@ def cell_positions(spacing_x, spacing_y, dimensions_x, dimensions_y, offset, mar
     return positions, top_cells
 
 
-class AdjacentCellFinder:
-    def __init__(self, cell_pos, num_edge_cells, x_dimensions, x_marker_size):
-        self.cell_pos = cell_pos
-        self.x_marker_size = x_marker_size
-        self.x_dimensions = x_dimensions
-
-        self.first_mid = num_edge_cells
-        self.first_bottom = len(cell_pos) - num_edge_cells
-
-    def _section(self, index):
-        if index < self.first_mid:
-            return 0
-        elif index < self.first_bottom:
-            return 1
-        else:
-            return 2
-
-    def _right(self, index):
-        r = index+1
-        if r >= len(self.cell_pos):
-            return None
-        if self.cell_pos[r][0] < self.cell_pos[index][0]:  # looped
-            return None
-        if self.cell_pos[r][1] != self.cell_pos[index][1]:  # sanity
-            return None
-        return r
-
-    def _left(self, index):
-        l = index-1
-        if l < 0:
-            return None
-        if self.cell_pos[l][0] > self.cell_pos[index][0]:  # looped
-            return None
-        if self.cell_pos[l][1] != self.cell_pos[index][1]:  # sanity
-            return None
-        return l
-
-    def _bottom(self, index):
-        # adjust for empty cells due to the marker margin
-        increment = self.x_dimensions
-        if self._section(index) in [0, 2]:
-            increment -= self.x_marker_size
-        b = index + increment
-        if self._section(b) in [0, 2]:
-            b -= self.x_marker_size
-
-        if b >= len(self.cell_pos):
-            return None
-        if self.cell_pos[b][0] != self.cell_pos[index][0]:  # sanity
-            return None
-        return b
-
-    def _top(self, index):
-        # adjust for empty cells due to the marker margin
-        decrement = self.x_dimensions
-        if self._section(index) in [0, 2]:
-            decrement -= self.x_marker_size
-        t = index - decrement
-        if self._section(t) in [0, 2]:
-            t += self.x_marker_size
-
-        if t < 0:
-            return None
-        if self.cell_pos[t][0] != self.cell_pos[index][0]:  # sanity
-            return None
-        return t
-
-    def find_adjacent(self, index):
-        adjs = [
-            self._right(index),
-            self._left(index),
-            self._bottom(index),
-            self._top(index),
-        ]
-        return [a for a in adjs if a is not None]
+CellLayout = namedtuple('CellLayout', 'positions neighbors seeds')
+
+
+@lru_cache(maxsize=None)
+def cell_layout(spacing_x, spacing_y, dimensions_x, dimensions_y, offset, marker_size_x, marker_size_y):
+    '''
+    cell_positions(), compiled to arrays:
+    * positions: (N, 2) x,y
+    * neighbors: (N, 4) indices of the right, left, bottom, and top cells. -1 if there isn't one.
+    * seeds: the four corner cells, where decoding starts
+    '''
+    positions, num_edge_cells = cell_positions(spacing_x, spacing_y, dimensions_x, dimensions_y, offset,
+                                               marker_size_x, marker_size_y)
+    positions = numpy.array(positions, dtype=numpy.int32)
+
+    # lay the cell indices out on a grid (with a border of -1s), and look up the neighbors from there
+    cols = (positions[:, 0] - offset) // spacing_x + 1
+    rows = (positions[:, 1] - offset) // spacing_y + 1
+    grid = numpy.full((dimensions_y + 2, dimensions_x + 2), -1, dtype=numpy.int32)
+    grid[rows, cols] = numpy.arange(len(positions))
+    neighbors = numpy.stack([grid[rows, cols+1], grid[rows, cols-1], grid[rows+1, cols], grid[rows-1, cols]], axis=1)
+
+    last_index = len(positions) - 1
+    small_row_len = dimensions_x - marker_size_x - marker_size_x - 1
+    seeds = numpy.array([0, small_row_len, last_index, last_index - small_row_len])
+
+    for a in (positions, neighbors, seeds):
+        a.setflags(write=False)
+    return CellLayout(positions, neighbors, seeds)
 
 
 class LinearDecodeOrder:
@@ -170,51 +126,66 @@ class LinearDecodeOrder:
         self.drift.update(best_dx, best_dy)
 
 
-class CellDecodeInstructions:
-    def __init__(self, index, drift, error_distance):
-        self.index = index
-        self.drift = drift
-        self.error_distance = error_distance
-
-    def __lt__(self, other):
-        return self.error_distance < other.error_distance
-
+class WavefrontDecodeOrder:
+    '''
+    a flood fill from the corner cells, handed out a wave at a time, so each wave can be decoded in one batch.
+    a wave is every cell on the frontier at the current lowest error distance -- cells found by a good decode go first.
+    Each cell inherits its drift from the adjacent cell that found it with the smallest error distance.
+    '''
+    NOT_FOUND = 0x7FFFFFFF
 
-class FloodDecodeOrder:
-    def __init__(self, positions, cell_finder):
-        self.positions = positions
-        self.cell_finder = cell_finder
+    def __init__(self, layout):
+        self.layout = layout
 
     def __iter__(self):
-        self.remaining = {i: coords for i, coords in enumerate(self.positions)}
-        self.heap = []
-        self.last = 0
-        # seed corners
-        last_index = len(self.positions)-1
-        small_row_len = self.cell_finder.x_dimensions - self.cell_finder.x_marker_size - self.cell_finder.x_marker_size - 1
-        heappush(self.heap, CellDecodeInstructions(0, cell_drift(), 0))
-        heappush(self.heap, CellDecodeInstructions(small_row_len, cell_drift(), 0))
-        heappush(self.heap, CellDecodeInstructions(last_index, cell_drift(), 0))
-        heappush(self.heap, CellDecodeInstructions(last_index-small_row_len, cell_drift(), 0))
+        num_cells = len(self.layout.positions)
+        self.remaining = numpy.ones(num_cells, dtype=bool)
+        self.drift = numpy.zeros((num_cells, 2), dtype=numpy.int8)
+        # error distance of the best decoded neighbor. Cells not on the frontier yet are at NOT_FOUND
+        self.priority = numpy.full(num_cells, self.NOT_FOUND, dtype=numpy.int32)
+        self.priority[self.layout.seeds] = 0
+        # cells that have been found, but not handed out yet. Kept up to date by update(), so it's only as big as
+        # the edge of the flood -- we never have to search the whole frame for it
+        self.frontier = numpy.unique(self.layout.seeds)
         return self
 
     def __next__(self):
-        try:
-            instr = heappop(self.heap)
-            while not self.remaining.pop(instr.index, None):
-                instr = heappop(self.heap)
-            self.last = instr.index
-            self.last_drift = instr.drift
-            # index, position, drift
-            return instr.index, self.positions[instr.index], instr.drift
-        except IndexError:
+        if not len(self.frontier):
             raise StopIteration()
 
-    def update(self, best_dx, best_dy, error_distance):
-        drift = copy(self.last_drift)
-        drift.update(best_dx, best_dy)
-        adjacents = self.cell_finder.find_adjacent(self.last)
-        for i in adjacents:
-            if i in self.remaining:
-                heappush(self.heap, CellDecodeInstructions(i, drift, error_distance))
+        priority = self.priority[self.frontier]
+        in_wave = priority == priority.min()
+        # in index order, so ties between parents go the same way however the frontier was found
+        self.wave = numpy.sort(self.frontier[in_wave])
+        self.frontier = self.frontier[~in_wave]
+        self.remaining[self.wave] = False
+        # indices, positions, drifts
+        return self.wave, self.layout.positions[self.wave], self.drift[self.wave]
 
+    def update(self, best_dx, best_dy, error_distance):
+        wave = self.wave
+        drift = self.drift[wave] + numpy.stack([best_dx, best_dy], axis=1)
+        self.drift[wave] = numpy.clip(drift, -cell_drift.limit, cell_drift.limit)
+
+        # best parents go first, so each neighbor's first appearance is its best parent in this wave
+        order = numpy.argsort(error_distance, kind='stable')
+        parents = wave[order]
+        adjacents = self.layout.neighbors[parents]
+        num_adjacent = adjacents.shape[1]
+        parents = numpy.repeat(parents, num_adjacent)
+        errors = numpy.repeat(numpy.asarray(error_distance)[order], num_adjacent)
+        adjacents = adjacents.ravel()
+        candidates = adjacents >= 0
+        candidates[candidates] = self.remaining[adjacents[candidates]]
+
+        adjacents, first = numpy.unique(adjacents[candidates], return_index=True)
+        parents = parents[candidates][first]
+        errors = errors[candidates][first]
+
+        # only take over cells we found with a smaller error than whoever found them before
+        better = errors < self.priority[adjacents]
+        adjacents = adjacents[better]
+        found = adjacents[self.priority[adjacents] == self.NOT_FOUND]
+        self.frontier = numpy.concatenate([self.frontier, found])
+        self.priority[adjacents] = errors[better]
+        self.drift[adjacents] = self.drift[parents[better]]
@@ -1,11 +1,20 @@
+from collections import namedtuple
+from hashlib import sha1
 from os import path
 
 import numpy
 import imagehash
 from PIL import Image
 
+from cimbar.encode.cell_hash import average_hashes, cell_windows, hamming_distances, pack_hashes
+
 
 CIMBAR_ROOT = path.abspath(path.join(path.dirname(path.realpath(__file__)), '..', '..'))
+COLOR_LUTS = {}  # in-memory cache of color lookup tables. See CimbDecoder.color_lut()
+MAX_COLOR_LUT_BITS = 7  # (2**7)^3 == 2M entries. Past that, the table costs more than it saves
+TILE_ASSETS = {}  # in-memory cache of compiled tiles. See tile_assets()
+
+TileAssets = namedtuple('TileAssets', 'tiles hashes')
 
 
 def possible_colors(dark, bits=0):
@@ -45,20 +54,104 @@ def possible_colors(dark, bits=0):
     return colors
 
 
-def load_tile(name, dark, replacements={}):
-    img = Image.open(name)
+def recolor(pixels, replacements):
+    '''
+    pixels is an (H, W, 4) RGBA array. Returns a copy with each current_color -> desired_color in replacements.
+    like the old per-pixel loop, the first matching replacement wins.
+    '''
+    recolored = pixels.copy()
+    todo = numpy.ones(pixels.shape[:2], dtype=bool)
+    for current_color, desired_color in replacements.items():
+        mask = todo & numpy.all(pixels == current_color, axis=-1)
+        recolored[mask] = tuple(desired_color) + (255,) * (4 - len(desired_color))
+        todo &= ~mask
+    return recolored
+
+
+def _tile_replacements(dark, replacements=None):
+    replacements = dict(replacements or {})
     if dark:
         replacements[(255, 255, 255, 255)] = (0, 0, 0, 255)
-
-    pixdata = img.load()
-    width, height = img.size
-    for y in range(height):
-        for x in range(width):
-            for current_color, desired_color in replacements.items():
-                if pixdata[x, y] == current_color:
-                    pixdata[x, y] = desired_color
-                    break
-    return img
+    return replacements
+
+
+def load_tile(name, dark, replacements=None):
+    pixels = numpy.asarray(Image.open(name).convert('RGBA'))
+    return Image.fromarray(recolor(pixels, _tile_replacements(dark, replacements)), 'RGBA')
+
+
+def _compile_tile_assets(symbol_bits, color_bits, dark):
+    symbols = [
+        numpy.asarray(Image.open(path.join(CIMBAR_ROOT, 'bitmap', f'{symbol_bits}', f'{i:02x}.png')).convert('RGBA'))
+        for i in range(2 ** symbol_bits)
+    ]
+
+    # the decoder compares against the uncolored tiles
+    plain = _tile_replacements(dark)
+    hashes = pack_hashes([imagehash.average_hash(Image.fromarray(recolor(pixels, plain), 'RGBA')).hash.flatten()
+                          for pixels in symbols])
+
+    # the encoder draws tile c * num_symbols + i for color c, symbol i
+    all_colors = possible_colors(dark, color_bits)
+    tiles = numpy.array([
+        recolor(pixels, _tile_replacements(dark, {(0, 255, 255, 255): all_colors[c]}))
+        for c in range(2 ** color_bits) for pixels in symbols
+    ])
+    return TileAssets(tiles, hashes)
+
+
+def tile_assets(symbol_bits, color_bits=0, dark=True):
+    '''
+    the recolored tiles and reference hashes for a (symbol_bits, color_bits, dark) combination.
+    built once per process, or loaded ahead of time with load_tile_assets().
+    '''
+    key = (symbol_bits, color_bits, bool(dark))
+    assets = TILE_ASSETS.get(key)
+    if assets:
+        return assets
+
+    assets = _compile_tile_assets(*key)
+    for a in assets:
+        a.setflags(write=False)
+    TILE_ASSETS[key] = assets
+    return assets
+
+
+def _tile_assets_key(key, field):
+    symbol_bits, color_bits, dark = key
+    return f'{symbol_bits}-{color_bits}-{int(dark)}-{field}'
+
+
+def save_tile_assets(filename, keys=None):
+    '''
+    writes the (symbol_bits, color_bits, dark) tile assets in keys -- default: everything built so far -- to one .npz
+    '''
+    keys = keys or list(TILE_ASSETS)
+    arrays = {}
+    for key in keys:
+        assets = tile_assets(*key)
+        for field in TileAssets._fields:
+            arrays[_tile_assets_key(key, field)] = getattr(assets, field)
+    numpy.savez(filename, **arrays)
+
+
+def load_tile_assets(filename):
+    '''
+    the inverse of save_tile_assets(). Returns the keys that were loaded.
+    '''
+    loaded = []
+    with numpy.load(filename) as f:
+        for name in f.files:
+            symbol_bits, color_bits, dark, field = name.split('-')
+            if field != 'tiles':
+                continue
+            key = (int(symbol_bits), int(color_bits), bool(int(dark)))
+            assets = TileAssets(**{field: f[_tile_assets_key(key, field)] for field in TileAssets._fields})
+            for a in assets:
+                a.setflags(write=False)
+            TILE_ASSETS[key] = assets
+            loaded.append(key)
+    return loaded
 
 
 def avg_color(img):
@@ -68,6 +161,25 @@ def avg_color(img):
     return tuple(nim.mean(axis=0))
 
 
+def summed_area_table(frame):
+    '''
+    (H, W, C) uint8 frame -> (H+1, W+1, C) int64 table, for computing the sum of any rectangle in constant time
+    '''
+    table = numpy.zeros((frame.shape[0] + 1, frame.shape[1] + 1) + frame.shape[2:], dtype=numpy.int64)
+    numpy.cumsum(numpy.cumsum(frame, axis=0, dtype=numpy.int64), axis=1, out=table[1:, 1:])
+    return table
+
+
+def avg_colors(table, xs, ys, size):
+    '''
+    batch version of avg_color(), for the size*size squares at (xs, ys). table comes from summed_area_table().
+    '''
+    xs = numpy.asarray(xs)
+    ys = numpy.asarray(ys)
+    total = table[ys + size, xs + size] - table[ys, xs + size] - table[ys + size, xs] + table[ys, xs]
+    return total / (size * size)
+
+
 def relative_color(c):
     r, g, b = c
     rg = r - g
@@ -83,40 +195,56 @@ def relative_color_diff(c1, c2):
 
 
 class CimbDecoder:
-    def __init__(self, dark, symbol_bits, color_bits=0, ccm=None):
+    def __init__(self, dark, symbol_bits, color_bits=0, ccm=None, color_lut_bits=None, color_lut_dir=None):
+        '''
+        color_lut_bits: if set, decode_colors() uses a (2**bits)^3 lookup table instead of doing the color math per cell.
+            Up to MAX_COLOR_LUT_BITS. The table is only used without a ccm -- a ccm is per image, so the table
+            would be too.
+        color_lut_dir: where to save/load lookup tables, if we want them to outlive the process.
+        '''
+        if color_lut_bits and not 0 < color_lut_bits <= MAX_COLOR_LUT_BITS:
+            raise ValueError(f'color_lut_bits must be between 0 and {MAX_COLOR_LUT_BITS}, not {color_lut_bits}')
         self.dark = dark
         self.symbol_bits = symbol_bits
         self.hashes = {}
 
         self.ccm = ccm
+        self.color_lut_bits = color_lut_bits
+        self.color_lut_dir = color_lut_dir
 
         all_colors = possible_colors(dark, color_bits)
         self.colors = {c: all_colors[c] for c in range(2 ** color_bits)}
 
-        for i in range(2 ** symbol_bits):
-            name = path.join(CIMBAR_ROOT, 'bitmap', f'{symbol_bits}', f'{i:02x}.png')
-            img = load_tile(name, self.dark)
-            ahash = imagehash.average_hash(img)
-            self.hashes[i] = ahash
+        self.hash_values = tile_assets(symbol_bits, color_bits, dark).hashes
+        hash_bits = numpy.unpackbits(self.hash_values.astype('>u8').view(numpy.uint8).reshape(-1, 8), axis=1)
+        for i, bits in enumerate(hash_bits):
+            self.hashes[i] = imagehash.ImageHash(bits.astype(bool).reshape(8, 8))
 
     def get_best_fit(self, cell_hash):
-        min_distance = 1000
-        best_fit = 0
-        for i, ihash in self.hashes.items():
-            distance = cell_hash - ihash
-            if distance < min_distance:
-                min_distance = distance
-                best_fit = i
-                if min_distance == 0:
-                    break
-        #if min_distance > 0:
-        #    print(f'min distance is {min_distance}. best fit {best_fit}')
-        return best_fit, min_distance
+        best_fits, distances = self.get_best_fits(pack_hashes(cell_hash.hash.reshape(1, -1)))
+        return int(best_fits[0]), int(distances[0])
+
+    def get_best_fits(self, cell_hashes):
+        '''
+        cell_hashes is an array of packed (uint64) hashes. Returns (best_fits, distances) arrays.
+        '''
+        distances = hamming_distances(cell_hashes, self.hash_values)
+        best_fits = distances.argmin(axis=1)
+        return best_fits, distances[numpy.arange(len(best_fits)), best_fits]
 
     def decode_symbol(self, img_cell):
         cell_hash = imagehash.average_hash(img_cell)
         return self.get_best_fit(cell_hash)  # make this return an object that knows how to get the color bits on demand???
 
+    def decode_symbols(self, frame, xs, ys, cell_size):
+        '''
+        batch version of decode_symbol().
+        frame is a grayscale numpy array, and (xs, ys) are the top left corners of the cells to decode.
+        returns (best_fits, distances) arrays.
+        '''
+        cells = cell_windows(frame, xs, ys, cell_size)
+        return self.get_best_fits(pack_hashes(average_hashes(cells)))
+
     def _check_color(self, c, d):
         #return (c[0] - d[0])**2 + (c[1] - d[1])**2 + (c[2] - d[2])**2
         return relative_color_diff(c, d)
@@ -129,9 +257,14 @@ class CimbDecoder:
 
     def _correct_all_colors(self, r, g, b):
         if self.ccm is not None:
-            r, g, b = self.ccm.dot(numpy.array([r, g, b]))
+            r, g, b = self._correct_colors(numpy.array([[r, g, b]]))[0]
         return r, g, b
 
+    def _correct_colors(self, colors):
+        if self.ccm is not None:
+            colors = numpy.einsum('ij,nj->ni', self.ccm, colors)
+        return colors
+
     def _best_color(self, r, g, b):
         r, g, b = self._correct_all_colors(r, g, b)
 
@@ -176,27 +309,118 @@ class CimbDecoder:
         bits = self._best_color(r, g, b)
         return bits << self.symbol_bits
 
+    def _scale_colors(self, colors, adjust, down):
+        colors = numpy.trunc((colors - down[:, None]) * adjust[:, None])
+        return numpy.where(colors > (245 - down[:, None]), 255, colors)
+
+    def _best_colors(self, colors):
+        '''
+        batch version of _best_color(), for an (N, 3) array of rgb values
+        '''
+        colors = self._correct_colors(colors)
+
+        if self.dark:
+            max_val = numpy.maximum(colors.max(axis=1), 1)
+            min_val = numpy.minimum(colors.min(axis=1), 48)
+            min_val = numpy.where(min_val >= max_val, 0, min_val)
+            adjust = 255.0 / (max_val - min_val)
+            colors = self._scale_colors(colors, adjust, min_val)
+        else:
+            min_val = colors.min(axis=1)
+            max_val = numpy.maximum(colors.max(axis=1), 1)
+            flat = max_val - min_val < 20
+            adjust = 255.0 / numpy.where(flat, 1, max_val - min_val)
+            colors = numpy.where(flat[:, None], 0, self._scale_colors(colors, adjust, min_val))
+
+        palette = numpy.array([relative_color(c) for _, c in sorted(self.colors.items())])
+        r, g, b = colors.T
+        rel = (r - g, g - b, b - r)
+        diffs = (palette[:, 0] - rel[0][:, None])**2 + (palette[:, 1] - rel[1][:, None])**2 + (palette[:, 2] - rel[2][:, None])**2
+        return diffs.argmin(axis=1)
+
+    def _build_color_lut(self, lut_bits):
+        # evaluate _best_colors() at the center of each bucket. A red level at a time, to keep the temporaries small
+        levels = (numpy.arange(2 ** lut_bits) + 0.5) * (256 / 2 ** lut_bits)
+        gb = numpy.stack(numpy.meshgrid(levels, levels, indexing='ij'), axis=-1).reshape(-1, 2)
+        lut = numpy.empty((len(levels),) * 3, dtype=numpy.uint8)
+        for i, r in enumerate(levels):
+            colors = numpy.column_stack([numpy.full(len(gb), r), gb])
+            lut[i] = self._best_colors(colors).reshape(lut.shape[1:])
+        return lut
+
+    def _color_lut_path(self, lut_bits):
+        if not self.color_lut_dir:
+            return None
+        palette = sha1(repr(sorted(self.colors.items())).encode()).hexdigest()[:16]
+        mode = 'dark' if self.dark else 'light'
+        return path.join(self.color_lut_dir, f'color-lut-{mode}-{palette}-{lut_bits}.npy')
+
+    def color_lut(self):
+        '''
+        maps (r >> shift, g >> shift, b >> shift) -> color bits, for the current palette and ccm.
+        tables without a ccm are cached. With one, the table is only good for the one image, so it isn't.
+        '''
+        lut_bits = self.color_lut_bits
+        if self.ccm is not None:
+            return self._build_color_lut(lut_bits)
+
+        key = (self.dark, tuple(sorted(self.colors.items())), lut_bits)
+        lut = COLOR_LUTS.get(key)
+        if lut is not None:
+            return lut
+
+        lut_path = self._color_lut_path(lut_bits)
+        if lut_path and path.exists(lut_path):
+            lut = numpy.load(lut_path)
+        else:
+            lut = self._build_color_lut(lut_bits)
+            if lut_path:
+                try:
+                    numpy.save(lut_path, lut)
+                except OSError as e:
+                    print(f'failed to save color lookup table {lut_path}: {e}')
+        COLOR_LUTS[key] = lut
+        return lut
+
+    def decode_colors(self, table, xs, ys, size):
+        '''
+        batch version of decode_color(), for the size*size squares at (xs, ys). table comes from summed_area_table().
+        '''
+        if len(self.colors) <= 1:
+            return numpy.zeros(len(xs), dtype=int)
+
+        colors = avg_colors(table, xs, ys, size)
+        if self.color_lut_bits and self.ccm is None:
+            lut = self.color_lut()
+            idx = numpy.minimum((colors * (len(lut) / 256)).astype(numpy.intp), len(lut) - 1)
+            bits = lut[idx[:, 0], idx[:, 1], idx[:, 2]].astype(int)
+        else:
+            bits = self._best_colors(colors)
+        return bits << self.symbol_bits
+
 
 class CimbEncoder:
     def __init__(self, dark, symbol_bits, color_bits=0):
         self.img = {}
         self.colors = {}
 
-        all_colors = possible_colors(dark, color_bits)
-        num_symbols = 2 ** symbol_bits
-        for c in range(2 ** color_bits):
-            color = all_colors[c]
-            for i in range(num_symbols):
-                name = path.join(CIMBAR_ROOT, 'bitmap', f'{symbol_bits}', f'{i:02x}.png')
-                self.img[c * num_symbols + i] = self._load_img(name, dark, color)
-
-    def _load_img(self, name, dark, color):
-        # replace by color...
-        replacements = {
-            (0, 255, 255, 255): color,
-        }
-        return load_tile(name, dark, replacements)
+        tiles = tile_assets(symbol_bits, color_bits, dark).tiles
+        for i, pixels in enumerate(tiles):
+            self.img[i] = Image.fromarray(pixels, 'RGBA')
+
+        # every tile, as an (N, height, width, 3) array
+        self.atlas = tiles[..., :3]
 
     def encode(self, bits):
         return self.img[bits]
 
+    def encode_cells(self, frame, xs, ys, cells):
+        '''
+        batch version of encode(): draws the tiles for an array of cell values onto frame (a numpy array) at (xs, ys)
+        '''
+        _, height, width, _ = self.atlas.shape
+        rows = numpy.asarray(ys)[:, None, None] + numpy.arange(height)[None, :, None]
+        cols = numpy.asarray(xs)[:, None, None] + numpy.arange(width)[None, None, :]
+        frame[rows, cols] = self.atlas[cells]
+        return frame
+
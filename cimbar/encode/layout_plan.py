@@ -0,0 +1,85 @@
+from collections import namedtuple
+from os import path
+
+import numpy
+
+from cimbar import conf
+from cimbar.encode.cell_positions import cell_layout
+from cimbar.util.interleave import interleave
+
+
+LayoutPlan = namedtuple('LayoutPlan', 'positions neighbors seeds interleave interleave_reverse blocks block_order')
+
+_PLANS = {}
+
+
+def _plan_params(config):
+    return (
+        config.CELL_SPACING_X, config.CELL_SPACING_Y, config.CELL_DIM_X, config.CELL_DIM_Y, config.CELLS_OFFSET,
+        config.MARKER_SIZE_X, config.MARKER_SIZE_Y, config.INTERLEAVE_BLOCKS, config.INTERLEAVE_PARTITIONS,
+    )
+
+
+def _plan_path(cache_dir, params):
+    sx, sy, dx, dy, offset, mx, my, blocks, partitions = params
+    return path.join(cache_dir, f'layout-{sx}x{sy}-{dx}x{dy}-{offset}-{mx}x{my}-{blocks}-{partitions}.npz')
+
+
+def _compute_plan(params):
+    layout = cell_layout(*params[:7])
+    interleave_blocks, interleave_partitions = params[7:]
+
+    num_cells = len(layout.positions)
+    ilv = numpy.fromiter(interleave(range(num_cells), interleave_blocks, interleave_partitions), dtype=numpy.int32,
+                         count=num_cells)
+    ilv_reverse = numpy.empty_like(ilv)
+    ilv_reverse[ilv] = numpy.arange(num_cells, dtype=numpy.int32)
+    block_size = num_cells // interleave_blocks // interleave_partitions
+    blocks = ilv_reverse // block_size
+    block_order = numpy.argsort(blocks, kind='stable').astype(numpy.int32)
+    return LayoutPlan(layout.positions, layout.neighbors, layout.seeds, ilv, ilv_reverse, blocks, block_order)
+
+
+def _load_plan(filename):
+    try:
+        with numpy.load(filename) as f:
+            return LayoutPlan(**{field: f[field] for field in LayoutPlan._fields})
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _save_plan(filename, plan):
+    try:
+        numpy.savez(filename, **plan._asdict())
+    except OSError as e:
+        print(f'failed to save layout plan {filename}: {e}')
+
+
+def layout_plan(config=conf, cache_dir=None):
+    '''
+    everything about where cells go that only depends on the config (e.g. conf.sq8x8, or the active conf):
+    * positions, neighbors, seeds: see cell_layout()
+    * interleave: cell index for each position in the interleaved (encoded) order
+    * interleave_reverse: the inverse of interleave -- interleaved position for each cell index
+    * blocks: the ECC block each cell index belongs to
+    * block_order: cell indices sorted by block -- the order the decoder writes them out in
+
+    plans are memoized, and if cache_dir is set, persisted as .npz files.
+    '''
+    params = _plan_params(config)
+    plan = _PLANS.get(params)
+    if plan:
+        return plan
+
+    filename = _plan_path(cache_dir, params) if cache_dir else None
+    if filename and path.exists(filename):
+        plan = _load_plan(filename)
+    if not plan:
+        plan = _compute_plan(params)
+        if filename:
+            _save_plan(filename, plan)
+
+    for a in plan:
+        a.setflags(write=False)
+    _PLANS[params] = plan
+    return plan
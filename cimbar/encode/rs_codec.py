@@ -0,0 +1,276 @@
+from functools import lru_cache
+
+import numpy
+from reedsolo import RSCodec, ReedSolomonError
+
+
+PRIM = 0x187
+FCR = 1
+
+
+class ReedsoloCodec:
+    '''
+    reedsolo's (pure python) RSCodec, one block at a time. This is the reference the other backends have to match.
+    '''
+    def __init__(self, ec, block_size):
+        self.ec = ec
+        self.block_size = block_size
+        self.rsc = RSCodec(ec, nsize=block_size, fcr=FCR, prim=PRIM)
+
+    def encode(self, data):
+        return bytes(self.rsc.encode(data))
+
+    def decode_block(self, block, erase_pos=None):
+        '''
+        returns the corrected data for one block, or None if there are too many errors.
+        erase_pos are the positions of bytes we think are wrong. An erasure only costs half as much ecc as an error
+        we know nothing about, but we only use them if the block doesn't decode without them:
+        every erasure that was fine after all is wasted ecc.
+        '''
+        try:
+            return bytes(self.rsc.decode(block)[0])
+        except ReedSolomonError:
+            if not erase_pos or len(erase_pos) > self.ec:
+                return None
+        try:
+            return bytes(self.rsc.decode(block, erase_pos=erase_pos)[0])
+        except ReedSolomonError:
+            return None
+
+    def _erase_pos(self, erasures, start):
+        if erasures is None:
+            return None
+        return numpy.flatnonzero(erasures[start:start+self.block_size]).tolist()
+
+    def decode(self, data, erasures=None):
+        '''
+        yields decode_block() for each block_size block in data.
+        erasures is an optional bool array, with an entry for each byte in data.
+        '''
+        for i in range(0, len(data), self.block_size):
+            yield self.decode_block(bytes(data[i:i+self.block_size]), self._erase_pos(erasures, i))
+
+
+@lru_cache(maxsize=None)
+def gf_tables(prim=PRIM):
+    '''
+    exp, log and (256, 256) multiplication tables for GF(2^8), with generator 2 -- the same field reedsolo uses
+    '''
+    exp = numpy.zeros(510, dtype=numpy.uint8)
+    log = numpy.zeros(256, dtype=numpy.int32)
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= prim
+    exp[255:] = exp[:255]
+
+    mul = exp[log[:, None] + log[None, :]]
+    mul[0, :] = 0
+    mul[:, 0] = 0
+    for t in (exp, log, mul):
+        t.setflags(write=False)
+    return exp, log, mul
+
+
+def _degree(polys):
+    # (D, W) polynomials, lowest degree first -> the degree of each one
+    nonzero = polys != 0
+    return polys.shape[1] - 1 - nonzero[:, ::-1].argmax(axis=1)
+
+
+class NumpyCodec(ReedsoloCodec):
+    '''
+    the same code (and wire format) as ReedsoloCodec, but table driven, and many blocks at a time.
+    Decoding checks the syndromes of every block at once, and blocks without errors are passed straight through.
+    The rest are corrected together: the same steps as reedsolo (forney syndromes, berlekamp-massey, chien search,
+    forney's algorithm), with the same checks, a step at a time for all of them. So the results match reedsolo's --
+    including which blocks it gives up on.
+    '''
+    def __init__(self, ec, block_size):
+        super().__init__(ec, block_size)
+        exp, log, self.mul = gf_tables(PRIM)
+        self.exp = exp
+        self.log = log
+        self.inverse = numpy.zeros(256, dtype=numpy.uint8)
+        self.inverse[1:] = exp[255 - log[1:]]
+
+        # generator polynomial (x - a^fcr)(x - a^(fcr+1))..., highest degree first
+        gen = numpy.array([1], dtype=numpy.uint8)
+        for i in range(ec):
+            root = exp[i + FCR]
+            gen = numpy.append(gen, 0) ^ numpy.append(0, self.mul[gen, root])
+        self.parity_table = self.mul[:, gen[1:]]  # (256, ec): what each feedback value adds to the remainder
+
+        # block[j] * a^((fcr+i) * (n-1-j)) summed over j is syndrome i
+        powers = numpy.arange(block_size - 1, -1, -1)[:, None] * numpy.arange(FCR, FCR + ec)[None, :]
+        self.syndrome_table = exp[powers % 255]
+
+        # byte j of a block is the coefficient of x^(n-1-j), so its error locator is a^(n-1-j)
+        degrees = numpy.arange(block_size - 1, -1, -1)
+        self.locators = exp[degrees % 255]
+        # a^-(n-1-j)^d: for evaluating (up to degree ec+1) polynomials at each byte's inverse locator
+        self.inverse_powers = exp[(-degrees[:, None] * numpy.arange(ec + 2)[None, :]) % 255]
+        self.fcr_adjust = exp[(degrees * (1 - FCR)) % 255]
+
+    def _parity(self, messages):
+        # polynomial division, one column (i.e. one byte of every message) at a time
+        remainder = numpy.zeros((len(messages), self.ec), dtype=numpy.uint8)
+        for column in messages.T:
+            feedback = column ^ remainder[:, 0]
+            remainder[:, :-1] = remainder[:, 1:]
+            remainder[:, -1] = 0
+            remainder ^= self.parity_table[feedback]
+        return remainder
+
+    def encode(self, data):
+        msg = numpy.frombuffer(data, dtype=numpy.uint8)
+        k = self.block_size - self.ec
+        full = len(msg) // k
+
+        messages = msg[:full * k].reshape(full, k)
+        encoded = [numpy.hstack((messages, self._parity(messages))).tobytes()]
+        if len(msg) > full * k:
+            tail = msg[None, full * k:]
+            encoded.append(numpy.hstack((tail, self._parity(tail))).tobytes())
+        return b''.join(encoded)
+
+    def syndromes(self, blocks):
+        '''
+        (N, block_size) array -> (N, ec) syndromes. All zeros means no errors.
+        '''
+        return numpy.bitwise_xor.reduce(self.mul[blocks[:, :, None], self.syndrome_table[None, :, :]], axis=1)
+
+    def _evaluate(self, polys):
+        # (D, W) polynomials, lowest degree first -> (D, block_size): each one at every byte's inverse locator.
+        # Only as many terms as the biggest one needs -- a few errors per block is the usual case
+        w = len(polys) and _degree(polys).max() + 1
+        polys = polys[:, :w]
+        return numpy.bitwise_xor.reduce(self.mul[polys[:, None, :], self.inverse_powers[None, :, :w]], axis=2)
+
+    def _multiply(self, a, b, width):
+        # (D, *) x (D, *) polynomials, lowest degree first, mod x^width
+        out = numpy.zeros((len(a), width), dtype=numpy.uint8)
+        for i in range(min(a.shape[1], width)):
+            n = min(b.shape[1], width - i)
+            out[:, i:i+n] ^= self.mul[a[:, i, None], b[:, :n]]
+        return out
+
+    def _forney_syndromes(self, synd, erasure_locators, erased):
+        # reedsolo's rs_forney_syndromes(): hide the erasures from the syndromes, so BM only has to find the errors
+        fsynd = synd.copy()
+        for x, active in zip(erasure_locators.T, erased.T):
+            shifted = self.mul[fsynd[:, :-1], x[:, None]] ^ fsynd[:, 1:]
+            fsynd[active, :-1] = shifted[active]
+        return fsynd
+
+    def _error_locator(self, fsynd, num_erasures):
+        # reedsolo's rs_find_error_locator() (berlekamp-massey), lowest degree first. Each block only runs
+        # ec - num_erasures iterations
+        num_blocks, ec = fsynd.shape
+        err = numpy.zeros((num_blocks, ec + 2), dtype=numpy.uint8)
+        err[:, 0] = 1
+        old = err.copy()
+        len_err = numpy.ones(num_blocks, dtype=int)
+        len_old = numpy.ones(num_blocks, dtype=int)
+        for k in range(ec):
+            active = k < ec - num_erasures
+            delta = fsynd[:, k] ^ numpy.bitwise_xor.reduce(self.mul[err[:, 1:k+1], fsynd[:, k-1::-1][:, :k]], axis=1)
+
+            shifted = numpy.zeros_like(old)
+            shifted[:, 1:] = old[:, :-1]
+            old[active] = shifted[active]
+            len_old[active] += 1
+
+            update = active & (delta != 0)
+            swap = update & (len_old > len_err)
+            new_old = self.mul[err[swap], self.inverse[delta[swap], None]]
+            err[swap] = self.mul[old[swap], delta[swap, None]]
+            old[swap] = new_old
+            len_old[swap], len_err[swap] = len_err[swap], len_old[swap]
+
+            err[update] ^= self.mul[old[update], delta[update, None]]
+            len_err[update] = numpy.maximum(len_err[update], len_old[update])
+        return err
+
+    def _correct(self, blocks, synd, erased):
+        '''
+        corrects (D, block_size) blocks with errors, given their syndromes and the (D, block_size) erasure mask.
+        returns (corrected blocks, ok).
+        '''
+        ec = self.ec
+        num_erasures = erased.sum(axis=1)
+        slots = numpy.arange(num_erasures.max(initial=0))
+        erased_slots = slots[None, :] < num_erasures[:, None]
+        positions = numpy.argsort(~erased, axis=1, kind='stable')[:, :len(slots)]
+        erasure_locators = numpy.where(erased_slots, self.locators[positions], 0).astype(numpy.uint8)
+
+        fsynd = self._forney_syndromes(synd, erasure_locators, erased_slots)
+        # BM only gets ec - num_erasures iterations, so there are never more errata than ecc
+        sigma = self._error_locator(fsynd, num_erasures)
+        num_errors = _degree(sigma)
+        ok = (num_errors - num_erasures) * 2 + num_erasures <= ec
+
+        # chien search: the errors are where sigma has a root. All of them have to be in the block
+        errors = self._evaluate(sigma) == 0
+        ok &= errors.sum(axis=1) == num_errors
+        ok &= ~(errors & erased).any(axis=1)
+        errata = errors | erased
+
+        # forney: magnitude = a^(n-1-j)^(1-fcr) * omega(X^-1) / errata_locator'(X^-1)
+        errata_locator = numpy.zeros((len(blocks), ec + 1), dtype=numpy.uint8)
+        errata_locator[:, 0] = 1
+        for x, active in zip(erasure_locators.T, erased_slots.T):
+            errata_locator[active, 1:] ^= self.mul[errata_locator[active, :-1], x[active, None]]
+        errata_locator = self._multiply(errata_locator, sigma, ec + 1)
+        omega = self._multiply(synd, errata_locator, ec)
+        derivative = errata_locator[:, 1:].copy()
+        derivative[:, 1::2] = 0
+
+        numerator = self.mul[self.fcr_adjust[None, :], self._evaluate(omega)]
+        denominator = self._evaluate(derivative)
+        ok &= ~(errata & (denominator == 0)).any(axis=1)
+        magnitude = self.exp[(self.log[numerator] - self.log[denominator]) % 255]
+        magnitude[numerator == 0] = 0
+
+        corrected = blocks ^ numpy.where(errata, magnitude, 0).astype(numpy.uint8)
+        ok &= ~self.syndromes(corrected).any(axis=1)
+        return corrected, ok
+
+    def _correct_some(self, blocks, synd, indices, erasures, decoded):
+        # corrects blocks[indices] into decoded. Returns the indices that didn't make it
+        k = self.block_size - self.ec
+        erased = numpy.zeros((len(indices), self.block_size), dtype=bool) if erasures is None else erasures[indices]
+        corrected, ok = self._correct(blocks[indices], synd[indices], erased)
+        for i, block in zip(indices[ok].tolist(), corrected[ok]):
+            decoded[i] = block[:k].tobytes()
+        return indices[~ok]
+
+    def decode(self, data, erasures=None):
+        '''
+        clean blocks come back as memoryviews of data -- no copies. They're only good until data changes.
+        '''
+        buff = numpy.frombuffer(data, dtype=numpy.uint8)
+        k = self.block_size - self.ec
+        full = len(buff) // self.block_size
+
+        blocks = buff[:full * self.block_size].reshape(full, self.block_size)
+        synd = self.syndromes(blocks)
+        clean = ~synd.any(axis=1)
+
+        # like decode_block(): first without the erasures, then with them, for the blocks that didn't make it
+        decoded = {}
+        retry = self._correct_some(blocks, synd, numpy.flatnonzero(~clean), None, decoded)
+        if erasures is not None and len(retry):
+            erased = numpy.asarray(erasures[:full * self.block_size], dtype=bool).reshape(full, self.block_size)
+            num_erasures = erased[retry].sum(axis=1)
+            self._correct_some(blocks, synd, retry[(num_erasures > 0) & (num_erasures <= self.ec)], erased, decoded)
+
+        for i, (block, ok) in enumerate(zip(blocks, clean.tolist())):
+            yield block[:k].data if ok else decoded.get(i)
+
+        start = full * self.block_size
+        if len(buff) > start:
+            yield self.decode_block(buff[start:].tobytes(), self._erase_pos(erasures, start))
@@ -1,14 +1,19 @@
-from reedsolo import RSCodec
+from cimbar.encode.rs_codec import NumpyCodec
 
 
 class reed_solomon_stream:
-    def __init__(self, f, ec, block_size, mode='read', on_failure=None):
+    def __init__(self, f, ec, block_size, mode='read', on_failure=None, codec=None):
+        '''
+        codec is the reed solomon backend, e.g. rs_codec.ReedsoloCodec. Default is rs_codec.NumpyCodec.
+        '''
         if mode not in ['read', 'write']:
             raise Exception('bad bit_file mode. Try "read" or "write"')
         self.mode = mode
-        self.rsc = RSCodec(ec, nsize=block_size, fcr=1, prim=0x187)
+        self.codec = codec or NumpyCodec(ec, block_size)
         self.block_size = block_size
         self.empty_block = b'\0' * (block_size-ec) if on_failure is None else on_failure
+        self.out = bytearray()
+        self.failed_blocks = 0
 
         if isinstance(f, str):
             fmode = 'wb' if mode == 'write' else 'rb'
@@ -28,18 +33,29 @@ class reed_solomon_stream:
             with self.f:  # close file
                 pass
 
-    def write(self, buffer):
-        i = 0
-        while i < len(buffer):
-            bu = buffer[i:i+self.block_size]
-            try:
-                decoded = bytes(self.rsc.decode(bu)[0])
-                self.f.write(decoded)
-            except:
-                print(f'failed decode at {i}')
-                self.f.write(self.empty_block)
-            i += self.block_size
+    def write(self, buffer, erasures=None):
+        '''
+        erasures is an optional bool array, flagging the bytes of buffer we aren't sure about
+        '''
+        # the decoded blocks are gathered into one (reused) buffer, and passed on as a single view.
+        # Like any write(), f is only allowed to look at it until it returns.
+        # A block is at most block_size-ec bytes once decoded -- or empty_block, for the ones that fail
+        num_blocks = -(-len(buffer) // self.block_size)
+        size = num_blocks * max(self.block_size - self.codec.ec, len(self.empty_block))
+        if len(self.out) < size:
+            self.out = bytearray(size)
+        out = memoryview(self.out)
+
+        n = 0
+        for i, decoded in enumerate(self.codec.decode(buffer, erasures)):
+            if decoded is None:
+                print(f'failed decode at {i * self.block_size}')
+                self.failed_blocks += 1
+                decoded = self.empty_block
+            out[n:n+len(decoded)] = decoded
+            n += len(decoded)
+        self.f.write(out[:n])
 
     def read(self, max_bytes):
         raw = self.f.read(max_bytes)
-        return self.rsc.encode(raw)
+        return self.codec.encode(raw)
@@ -1,15 +1,33 @@
+from .fountain_encoder_stream import WINDOW, default_segment_size
 from .header import fountain_header
 
 class fountain_decoder_stream:
-    def __init__(self, f, chunk_size):
+    '''
+    the other end of fountain_encoder_stream. Each segment (encode_id) gets its own wirehair decoder, so segments
+    decode independently, in whatever order their chunks show up. Finished segments are written out in order.
+
+    segment_size isn't in the header, so it has to match the encoder's -- by default, both derive it from the chunk
+    size. A segment smaller than that is the last one. So is one that's bigger: that's a single segment stream
+    from an encoder that doesn't do segments.
+    Only segments within `window` of the one we're waiting on are decoded, so memory stays at `window` decoders.
+    Chunks for segments further ahead are dropped -- the encoder only has `window` segments going at a time anyway.
+    '''
+    def __init__(self, f, chunk_size, encode_id=0, segment_size=None, window=WINDOW):
         self.write_size = chunk_size
         self.chunk_size = chunk_size - fountain_header.length
+        self.encode_id = encode_id
+        self.segment_size = segment_size or default_segment_size(self.chunk_size)
+        self.window = window
         if isinstance(f, str):
             self.f = open(f, 'wb')
         else:
             self.f = f
-        self.fountain = None
-        self.buffer = b''
+        self.decoders = {}
+        self.decoded = {}
+        self.next_segment = 0
+        self.dropped = 0  # chunks for segments too far ahead
+        self.buffer = bytearray(self.write_size)  # a partial chunk, carried over to the next write()
+        self.buffered = 0
         self.done = False
 
     @property
@@ -24,32 +42,78 @@ class fountain_decoder_stream:
             with self.f:
                 pass
 
-    def _reset(self, total_size):
-        from pywirehair import decoder
-        self.fountain = decoder(total_size, self.chunk_size)
+    def _segment(self, encode_id):
+        # encode_id is 7 bits. Count forward from the segment we're waiting on -- or, for the stragglers
+        # of segments we've already written, backward (None)
+        offset = (encode_id - self.encode_id - self.next_segment) & 0x7F
+        return self.next_segment + offset if offset < 0x40 else None
 
-    def write(self, buffer):
-        if self.done:
-            return True
+    def written(self, encode_id):
+        '''
+        whether encode_id's segment has been written out. Once it has, the id will come around again for a new one.
+        '''
+        return self._segment(encode_id) is None
 
-        self.buffer += buffer
-        if len(self.buffer) < self.write_size:
-            return False
+    def _decoder(self, segment, total_size):
+        if segment not in self.decoders:
+            from pywirehair import decoder
+            self.decoders[segment] = decoder(total_size, self.chunk_size)
+        return self.decoders[segment]
 
-        buffer = self.buffer[0:self.write_size]
-        self.buffer = self.buffer[self.write_size:]
+    def _decode_chunk(self, chunk):
+        hdr = fountain_header(chunk[0:fountain_header.length])
+        if not hdr.total_size and not hdr.chunk_id:
+            return  # zero padding, not the empty last segment. See _segment_encoder
+        segment = self._segment(hdr.encode_id)
+        if segment is None or segment in self.decoded:
+            return
+        if segment >= self.next_segment + self.window:
+            self.dropped += 1
+            return
 
-        # split buffer into header,chunk
-        # get chunk_id and total_size from header
-        hdr = fountain_header(buffer[0:fountain_header.length])
+        res = b''  # the empty last segment
+        if hdr.total_size:
+            # wirehair wants bytes. That's one chunk_size copy, but (unlike the rest) it doesn't grow with the frame
+            payload = bytes(chunk[fountain_header.length:])
+            res = self._decoder(segment, hdr.total_size).decode(hdr.chunk_id, payload)
+            if not res:
+                return
+            del self.decoders[segment]
+        self.decoded[segment] = (res, hdr.total_size != self.segment_size)
 
-        if not self.fountain:
-            self._reset(hdr.total_size)
+    def _flush(self):
+        while self.next_segment in self.decoded:
+            res, last = self.decoded.pop(self.next_segment)
+            self.f.write(res)
+            self.next_segment += 1
+            if last:
+                self.done = True
+                return
 
-        res = self.fountain.decode(hdr.chunk_id, buffer[fountain_header.length:])
-        if not res:
-            return False
+    def _chunks(self, buffer):
+        # whole chunks are decoded straight out of buffer. Only a chunk that straddles two writes is copied
+        view = memoryview(buffer).cast('B')
+        while view:
+            if not self.buffered and len(view) >= self.write_size:
+                yield view[:self.write_size]
+                view = view[self.write_size:]
+                continue
 
-        self.f.write(res)
-        self.done = True
-        return True
+            n = min(self.write_size - self.buffered, len(view))
+            self.buffer[self.buffered:self.buffered+n] = view[:n]
+            self.buffered += n
+            view = view[n:]
+            if self.buffered == self.write_size:
+                self.buffered = 0
+                yield memoryview(self.buffer)
+
+    def write(self, buffer):
+        '''
+        buffer can be anything bytes-like. We don't hang on to it after we return.
+        '''
+        for chunk in self._chunks(buffer):
+            if self.done:
+                break
+            self._decode_chunk(chunk)
+            self._flush()
+        return self.done
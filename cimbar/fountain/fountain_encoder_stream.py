@@ -1,12 +1,70 @@
+from collections import deque
+
 from .header import fountain_header
 
 
+SEGMENT_SIZE = 1 << 23  # bytes. Has to fit in fountain_header.total_size (25 bits)
+SEGMENT_CHUNKS = 0x7FFF  # REDUNDANCY * this (+1) fits in the 16 bit chunk_id. Wirehair's limit is 64000
+REDUNDANCY = 2  # how many chunks we send for each chunk of data in a segment
+WINDOW = 2  # segments in flight at once
+
+
+def default_segment_size(chunk_size):
+    '''
+    the segment size for chunk_size (payload) chunks: SEGMENT_SIZE, unless the chunks are too small to number that many.
+    It isn't in the header -- both ends work it out from the chunk size they already agree on.
+    '''
+    return min(SEGMENT_SIZE, SEGMENT_CHUNKS * chunk_size)
+
+
+class _segment_encoder:
+    '''
+    one segment of the input, with its own wirehair encoder. The header's encode_id says which segment a chunk is from,
+    and total_size is the size of the segment.
+    '''
+    def __init__(self, encode_id, contents, chunk_size):
+        self.encode_id = encode_id
+        self.len = len(contents)
+        self.chunk_size = chunk_size
+        self.chunk_id = 0
+        self.remaining = max(1, -(-self.len // chunk_size)) * REDUNDANCY
+
+        self.fountain = None
+        if contents:
+            from pywirehair import encoder
+            self.fountain = encoder(contents, chunk_size)
+        else:
+            # the last segment can be empty -- it just says "that was it". Its chunk ids start at 1: an all zero
+            # chunk is the padding at the end of the last frame, and mustn't look like the end of the stream
+            self.chunk_id = 1
+
+    def read_chunk(self):
+        self.remaining -= 1
+        bites = b'\0' * self.chunk_size
+        if self.fountain:
+            bites = b''
+            while len(bites) < self.chunk_size:
+                bites = self.fountain.encode(self.chunk_id)
+                self.chunk_id += 1
+        else:
+            self.chunk_id += 1
+        return bytes(fountain_header(self.encode_id, self.len, self.chunk_id - 1)) + bites
+
+
 class fountain_encoder_stream:
-    def __init__(self, f, chunk_size, encode_id=0):
-        self.buffer = b''
+    '''
+    the input is split into segment_size segments, which are encoded independently.
+    Only `window` segments are in memory at a time, and their chunks are interleaved.
+    A segment shorter than segment_size (possibly empty) is the last one.
+    read() returns b'' once every segment has sent its chunks.
+    segment_size defaults to default_segment_size().
+    '''
+    def __init__(self, f, chunk_size, encode_id=0, segment_size=None, window=WINDOW):
         self.read_size = chunk_size
         self.chunk_size = chunk_size - fountain_header.length
         self.encode_id = encode_id
+        self.segment_size = segment_size or default_segment_size(self.chunk_size)
+        self.window = window
 
         if isinstance(f, str):
             self.f = open(f, 'rb')
@@ -27,21 +85,39 @@ class fountain_encoder_stream:
                 pass
 
     def _reset(self):
-        from pywirehair import encoder
-        contents = self.f.read()
-        self.fountain = encoder(contents, self.chunk_size)
-        self.chunk_id = 0
-        self.len = len(contents)
+        self.segments = deque()
+        self.num_segments = 0
+        self.eof = False
+        self._load_segments()
 
-    def _header(self, chunk_id):
-        return bytes(fountain_header(self.encode_id, self.len, chunk_id))
+    def _read_segment(self):
+        # streams (e.g. zstd) can return less than we asked for before they're done
+        contents = bytearray()
+        while len(contents) < self.segment_size:
+            bites = self.f.read(self.segment_size - len(contents))
+            if not bites:
+                break
+            contents += bites
+        return bytes(contents)
+
+    def _load_segments(self):
+        while len(self.segments) < self.window and not self.eof:
+            contents = self._read_segment()
+            self.eof = len(contents) < self.segment_size
+            encode_id = (self.encode_id + self.num_segments) & 0x7F
+            self.segments.append(_segment_encoder(encode_id, contents, self.chunk_size))
+            self.num_segments += 1
 
     def read(self, max_bytes):
         if max_bytes % self.read_size != 0:
             raise Exception(f'{max_bytes} must be a multiple of {self.read_size}')
 
-        bites = b''
-        while len(bites) < self.chunk_size:
-            bites = self.fountain.encode(self.chunk_id)
-            self.chunk_id += 1
-        return self._header(self.chunk_id - 1) + bites
+        chunks = []
+        while len(chunks) < max_bytes // self.read_size and self.segments:
+            segment = self.segments.popleft()
+            chunks.append(segment.read_chunk())
+            if segment.remaining > 0:
+                self.segments.append(segment)
+            else:
+                self._load_segments()
+        return b''.join(chunks)
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+"""rs_benchmark.py
+
+compare the throughput of the reed solomon backends
+
+Usage:
+  ./rs_benchmark.py [--ecc=<0-150>] [--blocks=<n>] [--errors=<n>]
+  ./rs_benchmark.py (-h | --help)
+
+Examples:
+  python -m cimbar.rs_benchmark --errors=4
+
+Options:
+  -h --help                        Show this help.
+  --ecc=<0-150>                    Reed solomon error correction level. [default: 30]
+  --blocks=<n>                     How many blocks to encode and decode. [default: 1000]
+  --errors=<n>                     Byte errors per block. 0 is a clean frame. [default: 0]
+"""
+import random
+from time import perf_counter
+
+from docopt import docopt
+
+from cimbar import conf
+from cimbar.encode.rs_codec import NumpyCodec, ReedsoloCodec
+
+
+def _corrupt(encoded, block_size, errors):
+    encoded = bytearray(encoded)
+    for start in range(0, len(encoded), block_size):
+        for i in random.sample(range(block_size), errors):
+            encoded[start + i] ^= random.randrange(1, 256)
+    return bytes(encoded)
+
+
+def benchmark(codec, data, errors):
+    start = perf_counter()
+    encoded = codec.encode(data)
+    encode_time = perf_counter() - start
+
+    encoded = _corrupt(encoded, codec.block_size, errors)
+    start = perf_counter()
+    failures = sum(decoded is None for decoded in codec.decode(encoded))
+    return encode_time, perf_counter() - start, failures
+
+
+def main():
+    args = docopt(__doc__, version='cimbar rs benchmark 0.0.1')
+    ecc = int(args['--ecc'])
+    blocks = int(args['--blocks'])
+    errors = int(args['--errors'])
+
+    block_size = conf.ECC_BLOCK_SIZE
+    data = bytes(random.getrandbits(8) for _ in range((block_size - ecc) * blocks))
+    mb = len(data) / 1000000
+    for codec in (ReedsoloCodec(ecc, block_size), NumpyCodec(ecc, block_size)):
+        encode_time, decode_time, failures = benchmark(codec, data, errors)
+        print(f'{type(codec).__name__}: encode {mb / encode_time:.2f} MB/s, decode {mb / decode_time:.2f} MB/s'
+              f' ({failures} failed blocks)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,34 @@
 import bitstring
+import numpy
 from bitstring import Bits, BitStream
 
 
 MAX_ENCODING = 16384
 
 
+def unpack_cells(data, bits_per_op, bit_offset=0, count=None):
+    '''
+    split data (bytes) into an array of bits_per_op-sized values, starting at bit_offset.
+    count defaults to as many whole values as there are.
+    '''
+    bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))[bit_offset:]
+    if count is None:
+        count = len(bits) // bits_per_op
+    bits = bits[:count * bits_per_op].reshape(count, bits_per_op)
+    weights = 1 << numpy.arange(bits_per_op - 1, -1, -1)
+    dtype = numpy.uint8 if bits_per_op <= 8 else numpy.uint16
+    return bits.dot(weights).astype(dtype)
+
+
+def pack_cells(cells, bits_per_op):
+    '''
+    the inverse of unpack_cells(). The last byte is zero padded.
+    '''
+    shifts = numpy.arange(bits_per_op - 1, -1, -1)
+    bits = (numpy.asarray(cells)[:, None] >> shifts) & 1
+    return numpy.packbits(bits.astype(numpy.uint8)).tobytes()
+
+
 class bit_file:
     def __init__(self, f, bits_per_op, mode='read', keep_open=False, read_size=MAX_ENCODING, read_count=1):
         if mode not in ['read', 'write']:
@@ -34,6 +58,16 @@ class bit_file:
             with self.f:  # close file
                 pass
 
+    def _refill(self):
+        # read_count=None reads until f runs dry
+        bites = self.f.read(self.read_size)
+        self.stream.clear()
+        self.stream.append(Bits(bytes=bites))
+        if not bites:
+            self.read_count = 0
+        elif self.read_count:
+            self.read_count -= 1
+
     def write(self, bits):
         if isinstance(bits, bit_write_buffer):
             bits = bits.stream
@@ -42,10 +76,8 @@ class bit_file:
         self.stream.append(bits)
 
     def read(self):
-        if self.read_count and self.stream.bitpos == self.stream.length:
-            self.stream.clear()
-            self.stream.append(Bits(bytes=self.f.read(self.read_size)))
-            self.read_count -= 1
+        if self.read_count != 0 and self.stream.bitpos == self.stream.length:
+            self._refill()
 
         try:
             bits = self.stream.read(f'uint:{self.bits_per_op}')
@@ -56,6 +88,41 @@ class bit_file:
                 bits = 0
         return bits
 
+    def read_cells(self, count):
+        '''
+        equivalent to calling read() count times, but returns a numpy array
+        '''
+        cells = numpy.zeros(count, dtype=numpy.uint8 if self.bits_per_op <= 8 else numpy.uint16)
+        i = 0
+        while i < count:
+            if self.read_count != 0 and self.stream.bitpos == self.stream.length:
+                self._refill()
+
+            remaining = self.stream.length - self.stream.bitpos
+            if not remaining:
+                if not self.read_count:
+                    break  # everything after this is 0
+                i += 1
+                continue
+
+            n = min(remaining // self.bits_per_op, count - i)
+            if not n:  # the tail end of the stream
+                cells[i] = self.stream.read(f'uint:{remaining}')
+                i += 1
+                continue
+
+            start = self.stream.bitpos
+            end = start + n * self.bits_per_op
+            first_byte = start // 8
+            data = self.stream[first_byte * 8:min(-(-end // 8) * 8, self.stream.length)].tobytes()
+            cells[i:i+n] = unpack_cells(data, self.bits_per_op, start - first_byte * 8, n)
+            self.stream.bitpos = end
+            i += n
+
+        if self.read_count is None and self.stream.bitpos == self.stream.length:
+            self._refill()  # look ahead, so read_count is 0 once f is done -- rather than after an empty frame
+        return cells
+
     def save(self):
         self.f.write(self.stream.tobytes())
 
@@ -0,0 +1,22 @@
+from io import BytesIO
+from unittest import TestCase
+
+from cimbar.util.bit_file import bit_file, unpack_cells
+
+
+class BitFileTest(TestCase):
+    def test_unpack_cells(self):
+        self.assertEqual([0x3, 0x3c, 0x3f, 0x0], unpack_cells(b'\x0f\xcf\xc0', 6).tolist())
+        self.assertEqual([0xf, 0x67, 0x70], unpack_cells(b'\x0f\xcf\xc0', 7, bit_offset=1).tolist())
+        self.assertEqual([0xf], unpack_cells(b'\x0f\xcf\xc0', 4, bit_offset=4, count=1).tolist())
+
+    def test_read_cells_matches_read(self):
+        data = bytes(range(256)) * 3
+        for bits_per_op in [4, 5, 6, 7]:
+            for read_size, read_count, count in [(16384, 1, 1200), (100, 5, 40), (101, 9, 300), (3, 400, 900)]:
+                expected_file = bit_file(BytesIO(data), bits_per_op, read_size=read_size, read_count=read_count)
+                actual_file = bit_file(BytesIO(data), bits_per_op, read_size=read_size, read_count=read_count)
+                for _ in range(4):
+                    expected = [expected_file.read() for _ in range(count)]
+                    self.assertEqual(expected, actual_file.read_cells(count).tolist())
+                    self.assertEqual(expected_file.read_count, actual_file.read_count)
@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+import imagehash
+import numpy
+from PIL import Image
+
+from cimbar.encode import cell_hash
+from cimbar.encode.cell_hash import average_hashes, hamming_distances, pack_hashes, popcount
+
+
+class CellHashTest(TestCase):
+    def test_average_hashes_5x5(self):
+        cells = numpy.random.RandomState(5).randint(0, 256, (50, 5, 5), dtype=numpy.uint8)
+        hashes = average_hashes(cells)
+        for cell, h in zip(cells, hashes):
+            expected = imagehash.average_hash(Image.fromarray(cell))
+            self.assertEqual(expected.hash.flatten().tolist(), h.tolist())
+
+    def test_pack_hashes(self):
+        cells = numpy.random.RandomState(8).randint(0, 256, (10, 8, 8), dtype=numpy.uint8)
+        packed = pack_hashes(average_hashes(cells))
+        for cell, h in zip(cells, packed):
+            expected = imagehash.average_hash(Image.fromarray(cell))
+            self.assertEqual(str(expected), f'{int(h):016x}')
+
+    def test_hamming_distances(self):
+        hashes = numpy.array([0, 0xFF, 0xFFFFFFFFFFFFFFFF, 0x8000000000000001], dtype=numpy.uint64)
+        refs = numpy.array([0, 0xF0F0], dtype=numpy.uint64)
+        expected = [[0, 8], [8, 8], [64, 56], [2, 10]]
+        self.assertEqual(expected, hamming_distances(hashes, refs).tolist())
+
+        self.assertEqual([0, 8, 64, 2], popcount(hashes).tolist())
+        self.assertEqual([0, 8, 64, 2], cell_hash._table_popcount(hashes).tolist())
@@ -0,0 +1,38 @@
+from unittest import TestCase
+
+import numpy
+
+from cimbar.encode.cell_positions import cell_positions, cell_layout, WavefrontDecodeOrder
+
+
+class CellLayoutTest(TestCase):
+    def test_layout(self):
+        for params in [(9, 9, 112, 112, 8, 6, 6), (5, 6, 198, 165, 9, 11, 9)]:
+            positions, num_edge_cells = cell_positions(*params)
+            layout = cell_layout(*params)
+            self.assertEqual(positions, [tuple(p) for p in layout.positions.tolist()])
+            spacing = [(params[0], 0), (-params[0], 0), (0, params[1]), (0, -params[1])]
+            opposite = [1, 0, 3, 2]
+            for i, adjacent in enumerate(layout.neighbors):
+                for a, (dx, dy), o in zip(adjacent, spacing, opposite):
+                    if a >= 0:
+                        self.assertEqual((positions[i][0] + dx, positions[i][1] + dy), positions[a])
+                        self.assertEqual(i, layout.neighbors[a][o])
+            self.assertIs(layout, cell_layout(*params))
+
+
+class WavefrontDecodeOrderTest(TestCase):
+    def test_visits_every_cell_once(self):
+        layout = cell_layout(9, 9, 20, 20, 8, 3, 3)
+
+        seen = []
+        decode_order = WavefrontDecodeOrder(layout)
+        for wave, pos, drift in decode_order:
+            self.assertEqual(layout.positions[wave].tolist(), pos.tolist())
+            seen += wave.tolist()
+            ones = numpy.ones(len(wave), dtype=int)
+            decode_order.update(ones, -ones, ones)
+
+        self.assertEqual(sorted(seen), list(range(len(layout.positions))))
+        # every wave pushes the drift one step further, until it hits the limit
+        self.assertEqual([[7, -7]], numpy.unique(drift, axis=0).tolist())
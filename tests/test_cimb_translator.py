@@ -1,9 +1,14 @@
-from os import path
+from os import listdir, path
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
+import numpy
 from PIL import Image
 
-from cimbar.encode.cimb_translator import CimbDecoder
+from cimbar.encode.cimb_translator import (
+    CimbDecoder, CimbEncoder, TILE_ASSETS, load_tile, load_tile_assets, save_tile_assets, summed_area_table,
+    tile_assets,
+)
 
 
 CIMBAR_ROOT = path.abspath(path.join(path.dirname(path.realpath(__file__)), '..'))
@@ -40,3 +45,115 @@ class CimbDecoderTest(TestCase):
 
         color = cimb.decode_color(img2)
         self.assertEqual(color, 1 << 4)
+
+    def test_decode_symbols_matches_decode_symbol(self):
+        for symbol_bits, cell_size in [(4, 8), (2, 5)]:
+            cimb = CimbDecoder(True, symbol_bits, 2)
+            frame = numpy.random.RandomState(symbol_bits).randint(0, 256, (40, 40), dtype=numpy.uint8)
+            xs = numpy.arange(0, 30, 3)
+            ys = numpy.arange(30, 0, -3)
+
+            bits, distances = cimb.decode_symbols(frame, xs, ys, cell_size)
+            for x, y, b, d in zip(xs, ys, bits, distances):
+                cell = Image.fromarray(frame).crop((x, y, x + cell_size, y + cell_size))
+                self.assertEqual((b, d), cimb.decode_symbol(cell))
+
+    def test_get_best_fits(self):
+        for symbol_bits in [4, 5]:
+            cimb = CimbDecoder(False, symbol_bits)
+            best_fits, distances = cimb.get_best_fits(cimb.hash_values)
+            self.assertEqual(list(range(2 ** symbol_bits)), best_fits.tolist())
+            self.assertEqual([0] * 2 ** symbol_bits, distances.tolist())
+
+    def test_decode_colors_matches_decode_color(self):
+        frame = numpy.random.RandomState(3).randint(0, 256, (20, 60, 3), dtype=numpy.uint8)
+        frame[:, :20] //= 4  # some dim cells
+        table = summed_area_table(frame)
+        xs = numpy.arange(0, 55, 5)
+        ys = numpy.arange(0, 11) + 4
+
+        for dark in [True, False]:
+            cimb = CimbDecoder(dark, 4, 2)
+            colors = cimb.decode_colors(table, xs, ys, 5)
+            for x, y, c in zip(xs, ys, colors):
+                cell = Image.fromarray(frame).crop((x, y, x + 5, y + 5))
+                self.assertEqual(cimb.decode_color(cell), c)
+
+    def test_decode_colors_lookup_table(self):
+        with TemporaryDirectory() as tempdir:
+            for color_bits in [2, 3]:
+                exact = CimbDecoder(True, 4, color_bits)
+                cimb = CimbDecoder(True, 4, color_bits, color_lut_bits=6, color_lut_dir=tempdir)
+
+                # a frame of blurry palette colors
+                palette = numpy.array([c for _, c in sorted(exact.colors.items())], dtype=numpy.uint8)
+                frame = numpy.repeat(palette, 5, axis=0)[:, None, :].repeat(5, axis=1) * 0.8 + 20
+                table = summed_area_table(frame.astype(numpy.uint8))
+                ys = numpy.arange(0, len(palette) * 5, 5)
+                xs = numpy.zeros(len(ys), dtype=int)
+
+                expected = exact.decode_colors(table, xs, ys, 5)
+                self.assertEqual((numpy.arange(len(palette)) << 4).tolist(), expected.tolist())
+                self.assertEqual(expected.tolist(), cimb.decode_colors(table, xs, ys, 5).tolist())
+                self.assertIs(cimb.color_lut(), cimb.color_lut())
+
+            self.assertEqual(2, len(listdir(tempdir)))
+
+    def test_decode_colors_lookup_table_ccm(self):
+        # a ccm is per image, so its tables aren't cached -- and decode_colors() doesn't use them
+        ccm = numpy.array([[1.1, 0, 0], [0, 0.9, 0], [0, 0, 1]])
+        cimb = CimbDecoder(True, 4, 2, ccm=ccm, color_lut_bits=6)
+        self.assertIsNot(cimb.color_lut(), cimb.color_lut())
+
+        table = summed_area_table(numpy.full((10, 10, 3), (0, 200, 200), dtype=numpy.uint8))
+        xs = ys = numpy.array([0, 5])
+        expected = CimbDecoder(True, 4, 2, ccm=ccm).decode_colors(table, xs, ys, 5)
+        self.assertEqual(expected.tolist(), cimb.decode_colors(table, xs, ys, 5).tolist())
+
+        with self.assertRaises(ValueError):
+            CimbDecoder(True, 4, 2, color_lut_bits=8)
+
+
+class CimbEncoderTest(TestCase):
+    def test_encode_cells_matches_encode(self):
+        cimb = CimbEncoder(True, 4, 2)
+        cells = [0, 5, 17, 63, 40]
+        xs = numpy.array([0, 8, 16, 0, 20])
+        ys = numpy.array([0, 0, 3, 10, 12])
+
+        expected = Image.new('RGB', (32, 24))
+        for bits, x, y in zip(cells, xs, ys):
+            expected.paste(cimb.encode(bits), (int(x), int(y)))
+
+        frame = numpy.zeros((24, 32, 3), dtype=numpy.uint8)
+        cimb.encode_cells(frame, xs, ys, numpy.array(cells))
+        self.assertTrue(numpy.array_equal(numpy.asarray(expected), frame))
+
+
+class TileAssetsTest(TestCase):
+    def test_load_tile(self):
+        name = path.join(CIMBAR_ROOT, 'bitmap', '4', '03.png')
+        dark = numpy.asarray(load_tile(name, True, {(0, 255, 255, 255): (255, 0, 0)}))
+        self.assertEqual({(0, 0, 0, 255), (255, 0, 0, 255)}, set(map(tuple, dark.reshape(-1, 4).tolist())))
+
+        # the dark mode replacement shouldn't stick around for the next call
+        light = numpy.asarray(load_tile(name, False))
+        self.assertEqual({(0, 255, 255, 255), (255, 255, 255, 255)}, set(map(tuple, light.reshape(-1, 4).tolist())))
+
+    def test_save_and_load(self):
+        assets = tile_assets(4, 2, True)
+        self.assertEqual((64, 8, 8, 4), assets.tiles.shape)
+        self.assertEqual((16,), assets.hashes.shape)
+        self.assertIs(assets, tile_assets(4, 2, True))
+
+        with TemporaryDirectory() as tempdir:
+            filename = path.join(tempdir, 'tiles.npz')
+            save_tile_assets(filename, [(4, 2, True)])
+
+            del TILE_ASSETS[(4, 2, True)]
+            self.assertEqual([(4, 2, True)], load_tile_assets(filename))
+
+        loaded = tile_assets(4, 2, True)
+        self.assertIsNot(assets, loaded)
+        self.assertTrue(numpy.array_equal(assets.tiles, loaded.tiles))
+        self.assertTrue(numpy.array_equal(assets.hashes, loaded.hashes))
@@ -1,12 +1,17 @@
 import random
-from os import path
+from glob import glob
+from os import listdir, path
 from tempfile import TemporaryDirectory
 from unittest import TestCase
 
 import cv2
 import numpy
 
-from cimbar.cimbar import encode, decode, bits_per_op
+from cimbar import conf
+from cimbar.cimbar import encode, decode, decode_cells, bits_per_op, _byte_distances, _decode_frame, _frame_id
+from cimbar.cimbar import _load_caches, _prepare_image
+from cimbar.encode import layout_plan as lp
+from cimbar.encode.cimb_translator import COLOR_LUTS, TILE_ASSETS
 from cimbar.encode.rss import reed_solomon_stream
 from cimbar.grader import evaluate as evaluate_grader
 
@@ -96,6 +101,89 @@ class CimbarTest(TestCase):
         decode([self.encoded_file], out_no_ecc, dark=True, ecc=0)
         self.validate_grader(out_no_ecc, 200)
 
+    def test_decode_cells_in_memory(self):
+        skewed_image = self._temp_path('skewed.png')
+        _warp1(self.encoded_file, skewed_image)
+
+        decode_args = (True, 1, False, True, False)
+        expected = decode_cells(skewed_image, *decode_args)
+        with open(skewed_image, 'rb') as f:
+            self.assertTrue(numpy.array_equal(expected, decode_cells(f.read(), *decode_args)))
+        self.assertTrue(numpy.array_equal(expected, decode_cells(cv2.imread(skewed_image), *decode_args)))
+
+    def test_byte_distances(self):
+        # 6 bit cells: 4 cells per 3 bytes
+        distances = numpy.array([1, 9, 2, 3, 0, 0, 0, 5])
+        self.assertEqual([9, 9, 3, 0, 0, 5], _byte_distances(distances, 6, 6).tolist())
+
+    def test_decode_cells_direct_sample(self):
+        skewed_image = self._temp_path('skewed.png')
+        _warp1(self.encoded_file, skewed_image)
+
+        decode_args = (True, 1, False, True, False)
+        expected = decode_cells(skewed_image, *decode_args)
+        actual = decode_cells(skewed_image, *decode_args, direct_sample=True)
+        self.assertTrue(numpy.array_equal(expected, actual))
+
+    def test_encode_jobs(self):
+        serial = self._temp_path('serial.png')
+        encode(self.src_file, serial, dark=True)
+
+        parallel = self._temp_path('parallel.png')
+        encode(self.src_file, parallel, dark=True, jobs=2)
+
+        self.assertTrue(path.exists(parallel))
+        self.assertTrue(numpy.array_equal(cv2.imread(serial), cv2.imread(parallel)))
+        self.assertFalse(path.exists(parallel + '.1.png'))
+
+    def test_decode_jobs(self):
+        skewed_image = self._temp_path('skewed.jpg')
+        _warp1(self.encoded_file, skewed_image)
+        images = [self.encoded_file, skewed_image, self.encoded_file]
+
+        out_serial = self._temp_path('outfile_serial.txt')
+        decode(images, out_serial, dark=True, ecc=0)
+
+        out_parallel = self._temp_path('outfile_parallel.txt')
+        decode(images, out_parallel, dark=True, ecc=0, jobs=2)
+
+        with open(out_serial, 'rb') as f, open(out_parallel, 'rb') as g:
+            expected = f.read()
+            self.assertEqual(len(expected), 3 * 9300)
+            self.assertEqual(expected, g.read())
+
+    def test_load_caches(self):
+        cache_dir = self._temp_path('cache')
+        lp._PLANS.clear()
+        TILE_ASSETS.clear()
+        _load_caches(cache_dir, dark=True)
+        self.assertEqual(2, len(listdir(cache_dir)))
+
+        # the next run loads them
+        assets = dict(TILE_ASSETS)
+        TILE_ASSETS.clear()
+        _load_caches(cache_dir, dark=True)
+        self.assertEqual(list(assets), list(TILE_ASSETS))
+        for key, loaded in TILE_ASSETS.items():
+            self.assertIsNot(assets[key], loaded)
+            for a, b in zip(assets[key], loaded):
+                numpy.testing.assert_array_equal(a, b)
+
+    def test_load_caches_color_lut(self):
+        cache_dir = self._temp_path('cache_lut')
+        COLOR_LUTS.clear()
+        _load_caches(cache_dir, dark=True, color_lut_bits=5)
+        self.assertEqual(1, len([f for f in listdir(cache_dir) if f.startswith('color-lut-')]))
+        self.assertEqual(1, len(COLOR_LUTS))
+
+        # the next run loads it, and the decoders find it
+        lut = next(iter(COLOR_LUTS.values()))
+        COLOR_LUTS.clear()
+        _load_caches(cache_dir, dark=True, color_lut_bits=5)
+        ct = _prepare_image(self.encoded_file, True, False, False, False, False, color_lut_bits=5)[0]
+        self.assertIs(next(iter(COLOR_LUTS.values())), ct.color_lut())
+        numpy.testing.assert_array_equal(lut, ct.color_lut())
+
     def test_decode_perspective(self):
         skewed_image = self._temp_path('skewed.jpg')
         _warp1(self.encoded_file, skewed_image)
@@ -152,3 +240,38 @@ class RoundtripTest(TestCase):
         with open(self.src_file, 'rb') as f:
             expected = f.read()
         self.assertEquals(contents, expected)
+
+    def test_roundtrip_last_frame_first(self):
+        # e.g. a camera that started recording a looping display partway through
+        with open(self.src_file, 'wb') as f:
+            f.write(bytes(random.getrandbits(8) for _ in range(30000)))
+        dst_image = path.join(self.temp_dir.name, 'encode.png')
+        encode(self.src_file, dst_image, dark=True, fountain=True)
+
+        frames = [dst_image] + sorted(glob(f'{dst_image}.*.png'), key=lambda f: int(f.split('.')[-2]))
+        self.assertGreater(len(frames), 2)
+
+        out_path = path.join(self.temp_dir.name, 'out.txt')
+        decode(list(reversed(frames)), out_path, dark=True, deskew=False, auto_dewarp=False, fountain=True)
+
+        with open(out_path, 'rb') as f:
+            contents = f.read()
+        with open(self.src_file, 'rb') as f:
+            expected = f.read()
+        self.assertEqual(contents, expected)
+
+    def test_roundtrip_repeated_frames(self):
+        dst_image = path.join(self.temp_dir.name, 'encode.png')
+        encode(self.src_file, dst_image, dark=True, fountain=True)
+
+        decode_args = (True, False, False, False, False, None, False, None)
+        frame_bytes, _ = _decode_frame(decode_args, dst_image, ecc=conf.ECC)
+        frame_id = _frame_id(frame_bytes, conf.ECC)
+        self.assertEqual((0, 0), frame_id)
+        self.assertIsNone(_decode_frame(decode_args, dst_image, seen={frame_id}, ecc=conf.ECC))
+
+        # the same frame over and over, like a camera pointed at a slower screen
+        out_path = path.join(self.temp_dir.name, 'out.txt')
+        decode([dst_image] * 5, out_path, dark=True, deskew=False, auto_dewarp=False, fountain=True)
+        with open(out_path, 'rb') as f, open(self.src_file, 'rb') as g:
+            self.assertEqual(g.read(), f.read())
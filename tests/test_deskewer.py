@@ -0,0 +1,91 @@
+from os import environ, path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+import cv2
+import numpy
+
+from cimbar.deskew.deskewer import _REMAP_MAPS, _camera_params, correct_perspective, perspective_maps
+from cimbar.deskew.deskewer import undistort_points
+from cimbar.deskew.lens_profile import default_profiles_file, load_profile, save_profile
+
+
+class CorrectPerspectiveTest(TestCase):
+    def setUp(self):
+        self.img = numpy.random.default_rng(0).integers(0, 256, (300, 400, 3), dtype=numpy.uint8)
+        self.input_pts = [(20, 30), (380, 10), (390, 290), (10, 280)]
+        self.output_pts = [(0, 0), (255, 0), (255, 255), (0, 255)]
+
+    def test_matches_warp_perspective(self):
+        transformer = cv2.getPerspectiveTransform(numpy.float32(self.input_pts), numpy.float32(self.output_pts))
+        expected = cv2.warpPerspective(self.img, transformer, (256, 256))
+
+        actual = correct_perspective(self.img, (256, 256), self.input_pts, self.output_pts)
+        self.assertEqual(actual.shape, expected.shape)
+        # fixed point maps: off by a rounding step here and there
+        diff = numpy.abs(actual.astype(int) - expected)
+        self.assertLessEqual(diff.max(), 8)
+        self.assertLess(diff.mean(), 1)
+
+    def test_reuses_maps(self):
+        _REMAP_MAPS.clear()
+        maps = perspective_maps((256, 256), self.input_pts, self.output_pts)
+        # whole pixel corners that wobble by a pixel, like a camera on a tripod. Or either side of a rounding boundary
+        for dx, dy in [(1, 0), (0, -1), (1, 1), (-1, 1), (0.4, 0.6), (-0.6, -0.4)]:
+            jittered = [(x + dx, y + dy) for x, y in self.input_pts]
+            self.assertIs(maps, perspective_maps((256, 256), jittered, self.output_pts))
+        self.assertEqual(1, len(_REMAP_MAPS))
+
+        moved = [(x + 2, y) for x, y in self.input_pts]
+        self.assertIsNot(maps, perspective_maps((256, 256), moved, self.output_pts))
+        self.assertIsNot(maps, perspective_maps((256, 256), self.input_pts, self.output_pts, distortion_factor=0.001,
+                                                image_size=(400, 300)))
+        self.assertEqual(3, len(_REMAP_MAPS))
+
+    def test_out_buffer(self):
+        out = numpy.zeros((256, 256, 3), dtype=numpy.uint8)
+        res = correct_perspective(self.img, (256, 256), self.input_pts, self.output_pts, out=out)
+        self.assertIs(res, out)
+        expected = correct_perspective(self.img, (256, 256), self.input_pts, self.output_pts)
+        numpy.testing.assert_array_equal(out, expected)
+
+    def test_undistort_in_the_same_pass(self):
+        img = cv2.GaussianBlur(self.img, (7, 7), 0)
+        df = 0.003
+        cam, dist = _camera_params(400, 300, df)
+        undistorted = cv2.undistort(img, cam, dist)
+        expected = correct_perspective(undistorted, (256, 256), self.input_pts, self.output_pts)
+
+        # the corners we'd have found in the distorted image
+        distorted_pts = cv2.projectPoints(
+            numpy.float32([((x - 200) / 100, (y - 150) / 75, 1) for x, y in self.input_pts]),
+            numpy.zeros(3), numpy.zeros(3), cam, dist)[0].reshape(-1, 2)
+        input_pts = undistort_points(distorted_pts, (400, 300), df)
+        numpy.testing.assert_allclose(input_pts, self.input_pts, atol=0.01)
+
+        actual = correct_perspective(img, (256, 256), input_pts, self.output_pts, distortion_factor=df)
+        diff = numpy.abs(actual.astype(int) - expected)
+        self.assertLess(diff.mean(), 1)
+
+
+class LensProfileTest(TestCase):
+    def test_save_and_load(self):
+        with TemporaryDirectory() as tempdir:
+            filename = path.join(tempdir, 'profiles.json')
+            save_profile('phone', -0.004, filename)
+            save_profile('webcam', 0.002, filename)
+            save_profile('phone', -0.005, filename)
+
+            self.assertEqual(load_profile('phone', filename), -0.005)
+            self.assertEqual(load_profile('webcam', filename), 0.002)
+            with self.assertRaises(KeyError):
+                load_profile('tablet', filename)
+
+    def test_default_file(self):
+        with TemporaryDirectory() as tempdir:
+            with patch.dict(environ, {'XDG_CONFIG_HOME': tempdir}):
+                self.assertEqual(path.join(tempdir, 'cimbar', 'lens-profiles.json'), default_profiles_file())
+                save_profile('phone', -0.004)
+                self.assertEqual(load_profile('phone'), -0.004)
+            self.assertTrue(path.exists(path.join(tempdir, 'cimbar', 'lens-profiles.json')))
@@ -4,7 +4,7 @@ from unittest import TestCase
 
 from cimbar.fountain.header import fountain_header
 from cimbar.fountain.fountain_decoder_stream import fountain_decoder_stream
-from cimbar.fountain.fountain_encoder_stream import fountain_encoder_stream
+from cimbar.fountain.fountain_encoder_stream import SEGMENT_SIZE, default_segment_size, fountain_encoder_stream
 
 
 CIMBAR_ROOT = path.abspath(path.join(path.dirname(path.realpath(__file__)), '..'))
@@ -42,6 +42,14 @@ class FountainHeaderTest(TestCase):
         self.assertEqual(b'\x81\x07\x08\x09\x00\x00', bytes(fe))
 
 
+class SegmentSizeTest(TestCase):
+    def test_default_segment_size(self):
+        self.assertEqual(SEGMENT_SIZE, default_segment_size(394))
+        # small chunks: 2 chunk_ids per chunk of data has to fit in 16 bits
+        self.assertEqual(0x7FFF * 100, default_segment_size(100))
+        self.assertLess(2 * default_segment_size(100) // 100 + 1, 0x10000)
+
+
 class FountainTest(TestCase):
     def test_encode(self):
         data = b'0123456789' * 100
@@ -71,3 +79,85 @@ class FountainTest(TestCase):
 
         outbuff.seek(0)
         self.assertEqual(data, outbuff.read())
+
+    def test_round_trip_segments(self):
+        data = bytes(range(256)) * 20
+        fes = fountain_encoder_stream(BytesIO(data), 400, segment_size=2048, window=2)
+
+        chunks = []
+        r = fes.read(800)
+        while r:
+            chunks += [r[i:i+400] for i in range(0, len(r), 400)]
+            r = fes.read(800)
+
+        # 3 segments (2048, 2048, 1024 bytes), interleaved
+        self.assertEqual([0, 1, 0, 1], [fountain_header(c[:6]).encode_id for c in chunks[:4]])
+        self.assertEqual({0, 1, 2}, {fountain_header(c[:6]).encode_id for c in chunks})
+
+        # segment 2 comes first, but it's within 3 segments of the one we're waiting on
+        outbuff = BytesIO()
+        dec = fountain_decoder_stream(outbuff, 400, segment_size=2048, window=3)
+        done = [dec.write(c) for c in reversed(chunks)]
+        self.assertTrue(done[-1])
+        self.assertEqual(data, outbuff.getvalue())
+
+        # ... but not within 2. Its chunks are dropped, and we'd have to wait for them to come around again
+        dec = fountain_decoder_stream(BytesIO(), 400, segment_size=2048)
+        done = [dec.write(c) for c in reversed(chunks)]
+        self.assertFalse(done[-1])
+        self.assertEqual(2, dec.next_segment)
+        self.assertTrue(dec.dropped > 0)
+
+        # segments 0 and 1 are written. Their ids are free to come around again
+        self.assertEqual([True, True, False], [dec.written(i) for i in range(3)])
+        self.assertFalse(dec.written(0x41))  # 63 segments ahead
+
+    def test_bigger_than_segment(self):
+        # a single segment stream from an encoder with bigger segments is still just the one segment
+        data = bytes(range(256)) * 12
+        fes = fountain_encoder_stream(BytesIO(data), 400, segment_size=4096)
+
+        outbuff = BytesIO()
+        dec = fountain_decoder_stream(outbuff, 400, segment_size=2048)
+        r = fes.read(400)
+        while r and not dec.write(r):
+            r = fes.read(400)
+        self.assertTrue(dec.done)
+        self.assertEqual(data, outbuff.getvalue())
+
+    def test_round_trip_ragged_writes(self):
+        data = b'0123456789' * 100
+        fes = fountain_encoder_stream(BytesIO(data), 400)
+        encoded = fes.read(400) + fes.read(400) + fes.read(400) + fes.read(400)
+
+        outbuff = BytesIO()
+        dec = fountain_decoder_stream(outbuff, 400)
+        # chunks split across writes, and several in one
+        self.assertFalse(dec.write(encoded[:150]))
+        self.assertFalse(dec.write(bytearray(encoded[150:700])))
+        self.assertTrue(dec.write(memoryview(encoded)[700:]))
+        self.assertEqual(data, outbuff.getvalue())
+
+    def test_segment_size_multiple(self):
+        # the input fits exactly in one segment, so there's an empty one after it to say that's all
+        fes = fountain_encoder_stream(BytesIO(b'0123456789' * 200), 400, segment_size=2000)
+        headers = []
+        r = fes.read(400)
+        while r:
+            headers.append(fountain_header(r[:6]))
+            r = fes.read(400)
+        self.assertEqual([(1, 0, 1), (1, 0, 2)],
+                         [(h.encode_id, h.total_size, h.chunk_id) for h in headers if h.encode_id == 1])
+
+    def test_zero_padding(self):
+        # the end of the last frame is zero padding. That's not an empty last segment
+        data = bytes(range(256)) * 4
+        fes = fountain_encoder_stream(BytesIO(data), 400)
+        chunks = [fes.read(400) for _ in range(8)]
+
+        outbuff = BytesIO()
+        dec = fountain_decoder_stream(outbuff, 400)
+        self.assertFalse(dec.write(b'\0' * 800))
+        done = [dec.write(c) for c in chunks if c]
+        self.assertTrue(done[-1])
+        self.assertEqual(data, outbuff.getvalue())
@@ -1,7 +1,13 @@
 
+from io import BytesIO
 from unittest import TestCase
 
-from cimbar.util.interleave import interleave, interleave_reverse
+import numpy
+
+from cimbar import conf
+from cimbar.encode.layout_plan import layout_plan
+from cimbar.util.bit_file import pack_cells
+from cimbar.util.interleave import interleave, interleave_reverse, interleaved_writer
 
 
 class InterleaveTest(TestCase):
@@ -67,3 +73,15 @@ class InterleaveTest(TestCase):
             0, 5, 1, 6, 2, 7, 3, 8, 4, 9,
             10, 15, 11, 16, 12, 17, 13, 18, 14, 19
         ])
+
+    def test_block_order_matches_interleaved_writer(self):
+        for config, bits_per_op in [(conf.sq8x8, 6), (conf.sq5x6, 4), (conf.sq5x5, 5)]:
+            plan = layout_plan(config)
+            cells = numpy.random.RandomState(bits_per_op).randint(0, 2 ** bits_per_op, len(plan.positions))
+
+            expected = BytesIO()
+            with interleaved_writer(f=expected, bits_per_op=bits_per_op, mode='write', keep_open=True) as iw:
+                for i, bits in enumerate(cells):
+                    iw.write(int(bits), int(plan.blocks[i]))
+
+            self.assertEqual(expected.getvalue(), pack_cells(cells[plan.block_order], bits_per_op))
@@ -0,0 +1,39 @@
+from os import listdir
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import numpy
+
+from cimbar import conf
+from cimbar.encode import layout_plan as lp
+from cimbar.encode.cell_positions import cell_positions
+from cimbar.util.interleave import interleave, interleave_reverse
+
+
+class LayoutPlanTest(TestCase):
+    def test_plan_matches_interleave(self):
+        for config in [conf.sq8x8, conf.sq5x5, conf.sq5x6]:
+            cells, _ = cell_positions(config.CELL_SPACING_X, config.CELL_SPACING_Y, config.CELL_DIM_X,
+                                      config.CELL_DIM_Y, config.CELLS_OFFSET, config.MARKER_SIZE_X,
+                                      config.MARKER_SIZE_Y)
+            lookup, block_size = interleave_reverse(cells, config.INTERLEAVE_BLOCKS, config.INTERLEAVE_PARTITIONS)
+
+            plan = lp.layout_plan(config)
+            self.assertIs(plan, lp.layout_plan(config))
+            self.assertEqual(cells, [tuple(p) for p in plan.positions.tolist()])
+            self.assertEqual(list(interleave(cells, config.INTERLEAVE_BLOCKS, config.INTERLEAVE_PARTITIONS)),
+                             [cells[i] for i in plan.interleave])
+            self.assertEqual([lookup[i] for i in range(len(cells))], plan.interleave_reverse.tolist())
+            self.assertEqual([lookup[i] // block_size for i in range(len(cells))], plan.blocks.tolist())
+
+    def test_persist(self):
+        with TemporaryDirectory() as tempdir:
+            lp._PLANS.clear()
+            plan = lp.layout_plan(conf.sq5x6, cache_dir=tempdir)
+            self.assertEqual(1, len(listdir(tempdir)))
+
+            lp._PLANS.clear()
+            loaded = lp.layout_plan(conf.sq5x6, cache_dir=tempdir)
+            self.assertIsNot(plan, loaded)
+            for a, b in zip(plan, loaded):
+                numpy.testing.assert_array_equal(a, b)
@@ -1,7 +1,11 @@
+import random
 from io import BytesIO
 from os import path
 from unittest import TestCase
 
+import numpy
+
+from cimbar.encode.rs_codec import NumpyCodec, ReedsoloCodec
 from cimbar.encode.rss import reed_solomon_stream
 
 
@@ -25,3 +29,91 @@ class ReedSolomonStreamTest(TestCase):
             outbuff.seek(0)
             self.assertEqual(s, outbuff.read())
 
+    def test_write_frame_at_once(self):
+        data = bytes(range(250)) * 3
+        encoded = NumpyCodec(30, 155).encode(data)
+
+        writes = []
+        class recorder:
+            closed = False
+            def write(self, b):
+                writes.append(bytes(b))
+
+        rss = reed_solomon_stream(recorder(), 30, 155, mode='write')
+        rss.write(encoded)
+        rss.write(encoded[:310])
+        self.assertEqual([data, data[:250]], writes)
+
+    def test_write_failed_tail(self):
+        # a short block that doesn't decode still becomes a whole empty block
+        outbuff = BytesIO()
+        rss = reed_solomon_stream(outbuff, 30, 155, mode='write')
+        rss.write(bytes(range(1, 61)))
+        self.assertEqual(b'\0' * 125, outbuff.getvalue())
+        self.assertEqual(1, rss.failed_blocks)
+
+
+class NumpyCodecTest(TestCase):
+    def test_encode_matches_reedsolo(self):
+        rand = random.Random(1)
+        for ec in (30, 40, 33):
+            numpy_codec, reference = NumpyCodec(ec, 155), ReedsoloCodec(ec, 155)
+            for size in (0, 1, 155 - ec, 155 - ec + 1, 16384):
+                data = bytes(rand.getrandbits(8) for _ in range(size))
+                self.assertEqual(reference.encode(data), numpy_codec.encode(data))
+
+    def test_decode_matches_reedsolo(self):
+        rand = random.Random(2)
+        numpy_codec, reference = NumpyCodec(30, 155), ReedsoloCodec(30, 155)
+        encoded = bytearray(numpy_codec.encode(bytes(rand.getrandbits(8) for _ in range(125 * 40 + 50))))
+        # mostly clean blocks, some correctable ones, and a few that are hopeless
+        for i in rand.sample(range(len(encoded)), 200):
+            encoded[i] ^= rand.randrange(1, 256)
+        for i in range(155 * 3, 155 * 4):
+            encoded[i] = rand.getrandbits(8)
+
+        expected = list(reference.decode(bytes(encoded)))
+        self.assertIn(None, expected)
+        self.assertEqual(expected, list(numpy_codec.decode(bytes(encoded))))
+
+    def test_decode_erasures_matches_reedsolo(self):
+        rand = random.Random(4)
+        for ec in (30, 6):
+            numpy_codec, reference = NumpyCodec(ec, 155), ReedsoloCodec(ec, 155)
+            encoded = bytearray(numpy_codec.encode(bytes(rand.getrandbits(8) for _ in range((155 - ec) * 60))))
+            erasures = numpy.zeros(len(encoded), dtype=bool)
+            # errors and erasures, from easy to past what the ecc can do. Some erasures are on good bytes
+            for start in range(0, len(encoded), 155):
+                bad = rand.sample(range(start, start + 155), rand.randint(0, ec))
+                for i in bad:
+                    encoded[i] ^= rand.randrange(1, 256)
+                erased = bad[:rand.randint(0, len(bad))] + rand.sample(range(start, start + 155), rand.randint(0, 3))
+                erasures[erased] = True
+
+            expected = list(reference.decode(bytes(encoded), erasures))
+            self.assertIn(None, expected)
+            self.assertEqual(expected, list(numpy_codec.decode(bytes(encoded), erasures)))
+
+    def test_syndromes(self):
+        codec = NumpyCodec(30, 155)
+        blocks = bytearray(codec.encode(bytes(range(250))))
+        blocks[160] ^= 1
+        syndromes = codec.syndromes(numpy.frombuffer(blocks, dtype=numpy.uint8).reshape(-1, 155))
+        self.assertFalse(syndromes[0].any())
+        self.assertTrue(syndromes[1].any())
+
+    def test_erasures(self):
+        rand = random.Random(3)
+        codec = NumpyCodec(30, 155)
+        data = bytes(rand.getrandbits(8) for _ in range(125 * 2))
+        encoded = bytearray(codec.encode(data))
+        # too many errors for the first block... unless we know where they are
+        bad = rand.sample(range(155), 20)
+        for i in bad:
+            encoded[i] ^= 0xFF
+        erasures = numpy.zeros(len(encoded), dtype=bool)
+        self.assertEqual([None, data[125:]], list(codec.decode(bytes(encoded), erasures)))
+
+        erasures[bad] = True
+        erasures[rand.sample(range(155, 310), 5)] = True  # a clean block doesn't care
+        self.assertEqual([data[:125], data[125:]], list(codec.decode(bytes(encoded), erasures)))
@@ -0,0 +1,90 @@
+import random
+from os import path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import cv2
+import numpy
+
+from cimbar.cimbar import encode
+from cimbar.deskew.scanner import CimbarScanner, PyramidScanner, ScanState, scan_line
+
+
+def _scan_state(line, ratio):
+    state = ScanState(ratio)
+    results = []
+    for i, active in enumerate(line):
+        res = state.process(active)
+        if res:
+            results.append((i, res))
+    res = state.process(False)
+    if res:
+        results.append((len(line), res))
+    return results
+
+
+class ScanLineTest(TestCase):
+    def test_matches_scan_state(self):
+        rand = random.Random(123)
+        for ratio in ScanState.RATIO_LIMITS:
+            for _ in range(2000):
+                # runs of random lengths, so some of them look like anchors
+                runs = [rand.choice([1, 1, 2, 2, 3, 4, 6, 8, 12]) for _ in range(rand.randint(0, 14))]
+                line = numpy.repeat(numpy.arange(len(runs)) % 2 == rand.randint(0, 1), runs)
+
+                ends, widths = scan_line(line, ratio)
+                self.assertEqual(_scan_state(line, ratio), list(zip(ends.tolist(), widths.tolist())))
+
+    def test_anchor(self):
+        line = numpy.repeat([False, True, False, True, False, True, False], [3, 1, 1, 8, 1, 1, 3])
+        ends, widths = scan_line(line)
+        self.assertEqual([15], ends.tolist())
+        self.assertEqual([12], widths.tolist())
+
+        # at the edge
+        ends, widths = scan_line(line[:-3])
+        self.assertEqual([15], ends.tolist())
+        self.assertEqual([12], widths.tolist())
+
+        self.assertEqual([], scan_line(line, '1:2:2')[0].tolist())
+
+
+class PyramidScannerTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with TemporaryDirectory() as tempdir:
+            src_file = path.join(tempdir, 'infile.txt')
+            with open(src_file, 'wb') as f:
+                f.write(bytes(random.getrandbits(8) for _ in range(8000)))
+            encoded_file = path.join(tempdir, 'encoded.png')
+            encode(src_file, encoded_file, dark=True)
+            encoded = cv2.imread(encoded_file)
+
+        input_pts = [(0, 0), (0, 1023), (1023, 0), (1023, 1023)]
+        output_pts = [(1000, 500), (1100, 2500), (3000, 400), (2900, 2600)]
+        transformer = cv2.getPerspectiveTransform(numpy.float32(input_pts), numpy.float32(output_pts))
+        img = cv2.warpPerspective(encoded, transformer, (4000, 3000), borderValue=(40, 40, 40))
+        cls.img = cv2.GaussianBlur(img, (7, 7), 0)
+
+    def test_scan(self):
+        expected = CimbarScanner(self.img, True).scan()
+        align = PyramidScanner(self.img, True).scan()
+
+        self.assertEqual(4, len(align.corners))
+        for (x, y), (ex, ey) in zip(align.corners, expected.corners):
+            self.assertLessEqual(abs(x - ex), 2)
+            self.assertLessEqual(abs(y - ey), 2)
+
+    def test_scan_edges(self):
+        cs = PyramidScanner(self.img, True)
+        align = cs.scan_edges(cs.scan(), 30)
+        expected = [(1945, 458), (2942, 1561), (1955, 2544), (1057, 1551)]
+        for (x, y), (ex, ey) in zip(align.edges, expected):
+            self.assertLessEqual(abs(x - ex), 10)
+            self.assertLessEqual(abs(y - ey), 10)
+
+    def test_refine_fallback(self):
+        # no anchor at full resolution: we're left with the coarse position
+        blank = numpy.full((3000, 4000, 3), 40, dtype=numpy.uint8)
+        cs = PyramidScanner(blank, True)
+        self.assertEqual(cs._to_full((100, 50)), cs._refine((100, 50), 10, '1:1:4', True))
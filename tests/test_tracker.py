@@ -0,0 +1,51 @@
+import random
+from os import path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import cv2
+import numpy
+
+from cimbar.cimbar import encode
+from cimbar.deskew.scanner import CimbarScanner
+from cimbar.deskew.tracker import AnchorTracker
+
+
+def _frame(encoded, dx, dy):
+    input_pts = [(0, 0), (0, 1023), (1023, 0), (1023, 1023)]
+    output_pts = [(100+dx, 80+dy), (120+dx, 1150+dy), (1150+dx, 100+dy), (1140+dx, 1160+dy)]
+    transformer = cv2.getPerspectiveTransform(numpy.float32(input_pts), numpy.float32(output_pts))
+    img = cv2.warpPerspective(encoded, transformer, (1280, 1280), borderValue=(40, 40, 40))
+    return cv2.GaussianBlur(img, (5, 5), 0)
+
+
+class AnchorTrackerTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with TemporaryDirectory() as tempdir:
+            src_file = path.join(tempdir, 'infile.txt')
+            with open(src_file, 'wb') as f:
+                f.write(bytes(random.getrandbits(8) for _ in range(8000)))
+            encoded_file = path.join(tempdir, 'encoded.png')
+            encode(src_file, encoded_file, dark=True)
+            cls.encoded = cv2.imread(encoded_file)
+
+    def test_track(self):
+        tracker = AnchorTracker(True)
+        for i in range(6):
+            img = _frame(self.encoded, 5 * i, -3 * i)
+            align = tracker.scan(img)
+            self.assertEqual(CimbarScanner(img, True).scan().corners, align.corners)
+
+        self.assertEqual(5, tracker.hits)
+        self.assertEqual(1, tracker.misses)
+
+    def test_lost(self):
+        tracker = AnchorTracker(True)
+        tracker.scan(_frame(self.encoded, 0, 0))
+
+        # too far to track, so we fall back to a full scan
+        img = _frame(self.encoded, 100, 60)
+        self.assertEqual(CimbarScanner(img, True).scan().corners, tracker.scan(img).corners)
+        self.assertEqual(0, tracker.hits)
+        self.assertEqual(2, tracker.misses)